@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+'''
+    Offline benchmark of resize_instances.py.  Runs the full cutover of one pipeline
+    (resize_pipeline, as called by main()) against hand-written EC2 and SSM fakes on a
+    virtual clock for several cluster sizes, and reports the simulated cutover time,
+    the number of API calls, the time spent waiting on the client side rate limits and
+    the time spent in each phase.  The thread pool sizes and the API rate limits of
+    resize_instances.py are simulated on the virtual clock too.
+
+    No AWS account or network access is needed.  Sleeps and waiters advance the virtual
+    clock instead of waiting, so even a 50 node cutover is measured in about a second
+    and the numbers are the same on every run.
+
+    Example:  python benchmark_resize_instances.py --sizes 2 8 50 --latency reboot=120
+'''
+
+import argparse
+import bisect
+from concurrent.futures import Future
+import contextvars
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time as real_time
+import types
+
+from botocore.exceptions import WaiterError
+
+import resize_instances
+
+
+# Simulated latencies in seconds, override with --latency NAME=SECONDS.  Document names are SSM run times.
+DEFAULT_LATENCIES = {
+    'api_call': 0.1,                 # every API round trip
+    'instance_stop': 60,             # stop_instances until stopped
+    'instance_start': 45,            # start_instances until running
+    'status_checks': 120,            # running until both EC2 status checks are ok
+    'agent_start': 30,               # boot until the SSM agent is online
+    'reboot_down': 10,               # restart command until Windows goes down
+    'reboot': 90,                    # restart command until Windows is booted again
+    'tsm_node_start': 60,            # SSM agent online until TSM runs the node's processes again
+    'ssm_command': 5,                # any other SSM document
+    'TableauServiceStop': 120,
+    'TableauDeactivateLicenses': 30,
+    'TableauActivateLicenses': 30,
+    'TableauServiceRestart': 300,
+}
+
+# The simulated account and region: its availability zones, vCPUs of the instance types and standard vCPU quota.
+ACCOUNT_ID = '123456789012'
+REGION_NAME = 'us-west-2'
+AVAILABILITY_ZONES = ['us-west-2a', 'us-west-2b', 'us-west-2c']
+INSTANCE_TYPE_VCPUS = {'m5.2xlarge': 8, 'm5.4xlarge': 16, 'r5.8xlarge': 32, 'z1d.6xlarge': 24}
+STANDARD_VCPU_QUOTA = 2048
+
+# Virtual time 0 of every benchmark run, in epoch seconds.
+EPOCH = datetime.datetime(2020, 11, 21, tzinfo=datetime.timezone.utc).timestamp()
+
+virtual_now = contextvars.ContextVar('virtual_now', default=0.0)
+
+
+class VirtualTime:
+    # Replaces the time module inside resize_instances: sleeping advances the caller's virtual clock.
+    def monotonic(self):
+        return virtual_now.get()
+
+    def time(self):
+        return EPOCH + virtual_now.get()
+
+    def sleep(self, seconds):
+        virtual_now.set(virtual_now.get() + max(0, seconds))
+
+    def strftime(self, *args):
+        return real_time.strftime(*args)
+
+
+def advance_to(virtual_time):
+    if virtual_time > virtual_now.get():
+        virtual_now.set(virtual_time)
+
+
+def to_datetime(virtual_time):
+    return datetime.datetime.fromtimestamp(EPOCH + virtual_time, tz=datetime.timezone.utc)
+
+
+class VirtualFuture(Future):
+    # An already completed future; collecting it moves the caller's clock to the end of the task's timeline.
+    def result(self, timeout=None):
+        advance_to(self.end_time)
+        return super().result(timeout)
+
+    def exception(self, timeout=None):
+        advance_to(self.end_time)
+        return super().exception(timeout)
+
+
+def virtual_submit(executor, function, *args, **kwargs):
+    # Replaces resize_instances.submit_with_context.  The task runs right away on a copy of the caller's context,
+    # so tasks submitted together overlap on the virtual clock.  It starts at the caller's virtual time, or when
+    # the first of the executor's max_workers virtual workers is free, so a full pool queues tasks like the real
+    # one.  The fakes derive every state from timestamps, so running the tasks one after the other gives the same
+    # answers.
+    if not hasattr(executor, 'virtual_worker_free_times'):
+        executor.virtual_worker_free_times = [0.0] * executor._max_workers
+    context = contextvars.copy_context()
+    context.run(advance_to, heapq.heappop(executor.virtual_worker_free_times))
+    future = VirtualFuture()
+    try:
+        future.set_result(context.run(function, *args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    future.end_time = context[virtual_now]
+    heapq.heappush(executor.virtual_worker_free_times, future.end_time)
+
+    return future
+
+
+def virtual_wait(futures, timeout=None, return_when=None):
+    # Replaces resize_instances.wait, which is only used with FIRST_COMPLETED.  Every virtual future has already
+    # run, so the first completed are those with the earliest end time, and the caller's clock moves there.
+    end_time = min(future.end_time for future in futures)
+    advance_to(end_time)
+    done = {future for future in futures if future.end_time == end_time}
+
+    return done, set(futures) - done
+
+
+class VirtualTokenBucket:
+    # Replaces resize_instances.TokenBucket.  The tasks run one after the other, so the calls do not arrive in
+    # virtual time order and a bucket refilled from the last call would see time go backwards.  Instead every call
+    # is granted at the first time at or after the caller's that keeps at most burst granted calls in the
+    # burst / rate seconds before it, the same long term rate and burst as the real bucket.
+    def __init__(self, rate, burst):
+        self.window = burst / rate
+        self.burst = burst
+        self.grant_times = []
+
+    def acquire(self):
+        grant_time = virtual_now.get()
+        while True:
+            window_start = bisect.bisect_right(self.grant_times, grant_time - self.window)
+            window_end = bisect.bisect_right(self.grant_times, grant_time)
+            if window_end - window_start < self.burst:
+                break
+            grant_time = self.grant_times[window_end - self.burst] + self.window
+        bisect.insort(self.grant_times, grant_time)
+        wait_time = grant_time - virtual_now.get()
+        VirtualTime().sleep(wait_time)
+
+        return wait_time
+
+
+class VirtualOutputStreamer(resize_instances.CommandOutputStreamer):
+    # Replaces resize_instances.CommandOutputStreamer.  A real thread would poll on the wall clock; instead the
+    # output is read once when the command is done, off the caller's virtual clock like the real streamer thread,
+    # and before the run summary is taken so its calls are always counted.
+    def start(self):
+        pass
+
+    def stop(self):
+        contextvars.copy_context().run(self.poll)
+
+
+def install_virtual_clock():
+    resize_instances.time = VirtualTime()
+    resize_instances.submit_with_context = virtual_submit
+    resize_instances.wait = virtual_wait
+    resize_instances.TokenBucket = VirtualTokenBucket
+    resize_instances.CommandOutputStreamer = VirtualOutputStreamer
+
+
+def value_at(timeline, virtual_time):
+    # timeline is a list of (time, value); returns the latest value set at or before virtual_time.
+    current_value = None
+    for change_time, value in sorted(timeline, key=lambda change: change[0]):
+        if change_time > virtual_time:
+            break
+        current_value = value
+
+    return current_value
+
+
+class FakeInstance:
+    def __init__(self, instance_id, name, service_role, instance_type, repository, availability_zone):
+        self.instance_id = instance_id
+        self.name = name
+        self.service_role = service_role
+        self.instance_type = instance_type
+        self.repository = repository
+        self.availability_zone = availability_zone
+        self.states = [(float('-inf'), 'running')]
+        self.statuses = [(float('-inf'), 'ok')]
+        self.boots = [(float('-inf'), -3600.0)]
+        self.reboot_down = []
+
+    def state_at(self, virtual_time):
+        return value_at(self.states, virtual_time)
+
+    def status_at(self, virtual_time):
+        return value_at(self.statuses, virtual_time)
+
+    def last_boot_at(self, virtual_time):
+        return value_at(self.boots, virtual_time)
+
+    def agent_online_at(self, virtual_time, latencies):
+        if self.state_at(virtual_time) != 'running':
+            return False
+        if virtual_time < self.last_boot_at(virtual_time) + latencies['agent_start']:
+            return False
+        return not any(start <= virtual_time < end for start, end in self.reboot_down)
+
+    def agent_online_from(self, virtual_time, latencies):
+        # First virtual time at or after virtual_time the SSM agent is online, None if it never comes back.
+        candidates = [virtual_time]
+        candidates += [change_time for change_time, _ in self.states if change_time > virtual_time]
+        candidates += [boot_time + latencies['agent_start'] for _, boot_time in self.boots
+                       if boot_time + latencies['agent_start'] > virtual_time]
+        candidates += [end for _, end in self.reboot_down if end > virtual_time]
+        for candidate in sorted(candidates):
+            if self.agent_online_at(candidate, latencies):
+                return candidate
+
+        return None
+
+
+class FakeWorld:
+    def __init__(self, cluster_size, latencies, pipeline_id, instance_type='m5.2xlarge'):
+        self.latencies = latencies
+        self.pipeline_id = pipeline_id
+        self.instances = {}
+        # Like the real stacks: the primary plus all but the last two workers hold the repository, and at least
+        # the primary does.
+        for number in range(1, cluster_size + 1):
+            instance_id = f'i-{number:017x}'
+            self.instances[instance_id] = FakeInstance(instance_id, f'tableau-{number:02d}',
+                                                       'primary' if number == 1 else 'worker', instance_type,
+                                                       number <= max(1, cluster_size - 2),
+                                                       AVAILABILITY_ZONES[number % len(AVAILABILITY_ZONES)])
+        self.commands = {}
+        self.command_numbers = itertools.count(1)
+
+    def tsm_status_at(self, virtual_time):
+        # The cluster is DEGRADED while any node is down or has not started its processes since its last boot.
+        for instance in self.instances.values():
+            agent_online = instance.agent_online_at(virtual_time, self.latencies)
+            processes_started_at = (instance.last_boot_at(virtual_time) + self.latencies['agent_start'] +
+                                    self.latencies['tsm_node_start'])
+            if not agent_online or virtual_time < processes_started_at:
+                return 'DEGRADED'
+
+        return 'RUNNING'
+
+    def api_call(self, service_name, operation_name):
+        # Every fake call waits for its client side rate limit like a real one, then costs one round trip on the
+        # caller's clock and is counted.
+        resize_instances.limit_api_call_rate(types.SimpleNamespace(
+            name=operation_name, service_model=types.SimpleNamespace(service_name=service_name)))
+        resize_instances.add_metric('api_calls', f'{service_name}.{operation_name}', 1)
+        VirtualTime().sleep(self.latencies['api_call'])
+        return virtual_now.get()
+
+
+class FakePaginator:
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        yield self.operation(**kwargs)
+
+
+class FakeWaiter:
+    # Same polling as the boto3 EC2 waiters: every 15 seconds, 40 attempts.
+    def __init__(self, client, name, accepted):
+        self.client = client
+        self.name = name
+        self.accepted = accepted
+
+    def wait(self, InstanceIds, delay=15, max_attempts=40):
+        for _ in range(max_attempts):
+            if all(self.accepted(record) for record in self.client.describe_records(InstanceIds)):
+                return
+            VirtualTime().sleep(delay)
+        raise WaiterError(name=self.name, reason='Max attempts exceeded', last_response={})
+
+
+class FakeEC2Client:
+    def __init__(self, world):
+        self.world = world
+        self.meta = types.SimpleNamespace(region_name=REGION_NAME)
+        self.capacity_reservation_numbers = itertools.count(1)
+
+    def describe_records(self, instance_ids):
+        now = self.world.api_call('ec2', 'DescribeInstances')
+        return [(self.world.instances[instance_id], now) for instance_id in instance_ids]
+
+    def describe_instances(self, Filters=None, InstanceIds=None):
+        now = self.world.api_call('ec2', 'DescribeInstances')
+        described_instances = []
+        for instance in self.world.instances.values():
+            if InstanceIds and instance.instance_id not in InstanceIds:
+                continue
+            described_instances.append({
+                'InstanceId': instance.instance_id,
+                'InstanceType': instance.instance_type,
+                'PrivateDnsName': f'ip-{instance.instance_id[-6:]}.{REGION_NAME}.compute.internal',
+                'Placement': {'AvailabilityZone': instance.availability_zone},
+                'State': {'Name': instance.state_at(now)},
+                'Tags': [{'Key': 'Name', 'Value': instance.name},
+                         {'Key': 'service-role', 'Value': instance.service_role},
+                         {'Key': 'tableau-repository', 'Value': str(instance.repository).lower()},
+                         {'Key': 'stack-pipeline-number', 'Value': self.world.pipeline_id}]
+            })
+
+        return {'Reservations': [{'Instances': described_instances}]}
+
+    def describe_instance_status(self, InstanceIds, IncludeAllInstances=True):
+        now = self.world.api_call('ec2', 'DescribeInstanceStatus')
+        instance_statuses = []
+        for instance_id in InstanceIds:
+            status = self.world.instances[instance_id].status_at(now)
+            instance_statuses.append({
+                'InstanceId': instance_id,
+                'InstanceStatus': {'Status': status},
+                'SystemStatus': {'Status': status}
+            })
+
+        return {'InstanceStatuses': instance_statuses}
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+    def get_waiter(self, waiter_name):
+        if waiter_name == 'instance_stopped':
+            return FakeWaiter(self, waiter_name, lambda record: record[0].state_at(record[1]) == 'stopped')
+        if waiter_name == 'instance_status_ok':
+            return FakeWaiter(self, waiter_name, lambda record: record[0].status_at(record[1]) == 'ok')
+        raise ValueError(f'No fake waiter {waiter_name}.')
+
+    def stop_instances(self, InstanceIds):
+        now = self.world.api_call('ec2', 'StopInstances')
+        for instance_id in InstanceIds:
+            instance = self.world.instances[instance_id]
+            instance.states += [(now, 'stopping'), (now + self.world.latencies['instance_stop'], 'stopped')]
+            instance.statuses.append((now, 'not-applicable'))
+
+        return {'StoppingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+    def start_instances(self, InstanceIds):
+        now = self.world.api_call('ec2', 'StartInstances')
+        for instance_id in InstanceIds:
+            instance = self.world.instances[instance_id]
+            running_time = now + self.world.latencies['instance_start']
+            instance.states += [(now, 'pending'), (running_time, 'running')]
+            instance.statuses += [(now, 'initializing'),
+                                  (running_time + self.world.latencies['status_checks'], 'ok')]
+            instance.boots.append((running_time, running_time))
+
+        return {'StartingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+    def modify_instance_attribute(self, InstanceId, InstanceType):
+        self.world.api_call('ec2', 'ModifyInstanceAttribute')
+        self.world.instances[InstanceId].instance_type = InstanceType['Value']
+        return {}
+
+    def describe_instance_type_offerings(self, LocationType, Filters):
+        self.world.api_call('ec2', 'DescribeInstanceTypeOfferings')
+        return {'InstanceTypeOfferings': [{'InstanceType': Filters[0]['Values'][0], 'Location': availability_zone}
+                                          for availability_zone in AVAILABILITY_ZONES]}
+
+    def describe_instance_types(self, InstanceTypes):
+        self.world.api_call('ec2', 'DescribeInstanceTypes')
+        return {'InstanceTypes': [{'InstanceType': instance_type,
+                                   'VCpuInfo': {'DefaultVCpus': INSTANCE_TYPE_VCPUS[instance_type]}}
+                                  for instance_type in InstanceTypes]}
+
+    def create_capacity_reservation(self, **kwargs):
+        self.world.api_call('ec2', 'CreateCapacityReservation')
+        return {'CapacityReservation': {'CapacityReservationId': f'cr-{next(self.capacity_reservation_numbers):017x}'}}
+
+    def cancel_capacity_reservation(self, CapacityReservationId):
+        self.world.api_call('ec2', 'CancelCapacityReservation')
+        return {'Return': True}
+
+
+class FakeServiceQuotasClient:
+    def __init__(self, world):
+        self.world = world
+
+    def get_service_quota(self, ServiceCode, QuotaCode):
+        self.world.api_call('service-quotas', 'GetServiceQuota')
+        return {'Quota': {'ServiceCode': ServiceCode, 'QuotaCode': QuotaCode, 'Value': float(STANDARD_VCPU_QUOTA)}}
+
+
+class FakeSTSClient:
+    def __init__(self, world):
+        self.world = world
+
+    def get_caller_identity(self):
+        self.world.api_call('sts', 'GetCallerIdentity')
+        return {'Account': ACCOUNT_ID, 'Arn': f'arn:aws:iam::{ACCOUNT_ID}:role/benchmark', 'UserId': 'benchmark'}
+
+
+class FakeCommandInvocation:
+    def __init__(self, start_time, end_time, output):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.output = output
+
+    def status_at(self, virtual_time):
+        if self.start_time is None or virtual_time < self.start_time:
+            return 'Pending'
+        if virtual_time < self.end_time:
+            return 'InProgress'
+        return 'Success'
+
+
+class FakeSSMClient:
+    def __init__(self, world):
+        self.world = world
+
+    def send_command(self, InstanceIds, DocumentName, Parameters=None, CloudWatchOutputConfig=None):
+        now = self.world.api_call('ssm', 'SendCommand')
+        latencies = self.world.latencies
+        commands = ' '.join((Parameters or {}).get('commands', []))
+        command_id = f'command-{next(self.world.command_numbers)}'
+        invocations = {}
+        for instance_id in InstanceIds:
+            instance = self.world.instances[instance_id]
+            start_time = instance.agent_online_from(now, latencies)
+            output = ''
+            if start_time is None:
+                end_time = None
+            elif 'restart_computer.ps1' in commands:
+                end_time = start_time + 1
+                boot_time = start_time + latencies['reboot']
+                instance.boots.append((boot_time, boot_time))
+                instance.reboot_down.append((start_time + latencies['reboot_down'], boot_time))
+            elif 'tsm status' in commands:
+                end_time = start_time + latencies['ssm_command']
+                output = f'Status: {self.world.tsm_status_at(start_time)}'
+            elif 'LastBootUpTime' in commands:
+                end_time = start_time + 1
+                output = str(int(EPOCH + instance.last_boot_at(start_time)))
+            else:
+                end_time = start_time + latencies.get(DocumentName, latencies['ssm_command'])
+            invocations[instance_id] = FakeCommandInvocation(start_time, end_time, output)
+        self.world.commands[command_id] = invocations
+
+        return {'Command': {'CommandId': command_id, 'DocumentName': DocumentName,
+                            'RequestedDateTime': to_datetime(now)}}
+
+    def list_command_invocations(self, CommandId):
+        now = self.world.api_call('ssm', 'ListCommandInvocations')
+        return {'CommandInvocations': [{'InstanceId': instance_id, 'Status': invocation.status_at(now)}
+                                       for instance_id, invocation in self.world.commands[CommandId].items()]}
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        now = self.world.api_call('ssm', 'GetCommandInvocation')
+        invocation = self.world.commands[CommandId][InstanceId]
+        return {'Status': invocation.status_at(now), 'StandardOutputContent': invocation.output}
+
+    def cancel_command(self, CommandId):
+        self.world.api_call('ssm', 'CancelCommand')
+        return {}
+
+    def describe_instance_information(self, Filters):
+        now = self.world.api_call('ssm', 'DescribeInstanceInformation')
+        instance_information = []
+        for instance_id in Filters[0]['Values']:
+            online = self.world.instances[instance_id].agent_online_at(now, self.world.latencies)
+            instance_information.append({
+                'InstanceId': instance_id,
+                'PingStatus': 'Online' if online else 'ConnectionLost',
+                'LastPingDateTime': to_datetime(now if online else now - 300)
+            })
+
+        return {'InstanceInformationList': instance_information}
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+
+class FakeLogsClient:
+    # The CloudWatch output of the fake commands: one stdout stream per invocation with output, written in one
+    # event once the invocation has finished.
+    def __init__(self, world):
+        self.world = world
+
+    def describe_log_streams(self, logGroupName, logStreamNamePrefix):
+        now = self.world.api_call('logs', 'DescribeLogStreams')
+        command_id = logStreamNamePrefix.rstrip('/')
+        return {'logStreams': [{'logStreamName': f'{command_id}/{instance_id}/aws-runPowerShellScript/stdout'}
+                               for instance_id, invocation in self.world.commands.get(command_id, {}).items()
+                               if invocation.output and invocation.status_at(now) == 'Success']}
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead, nextToken=None):
+        self.world.api_call('logs', 'GetLogEvents')
+        command_id, instance_id = logStreamName.split('/')[:2]
+        if nextToken:
+            return {'events': [], 'nextForwardToken': nextToken}
+        return {'events': [{'message': self.world.commands[command_id][instance_id].output}],
+                'nextForwardToken': 'f/1'}
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+
+def run_benchmark(cluster_size, latencies, instance_type, work_dir, extra_arguments=()):
+    # Resizes one simulated pipeline of cluster_size nodes from virtual time 0 and returns its summary.
+    pipeline_id = f'benchmark-{cluster_size}'
+    # Every run starts at virtual time 0, so it needs rate limiters without the calls of the previous runs.
+    resize_instances.api_rate_limiters.clear()
+    world = FakeWorld(cluster_size, latencies, pipeline_id)
+    clients = {
+        'ec2_client': FakeEC2Client(world),
+        'ssm_client': FakeSSMClient(world),
+        'logs_client': FakeLogsClient(world),
+        'service_quotas_client': FakeServiceQuotasClient(world),
+        'sts_client': FakeSTSClient(world)
+    }
+    # Checkpoints, history and the preflight cache go to a scratch directory, simulated runs must not feed real
+    # --plan estimates.
+    arguments = resize_instances.set_arguments(['--checkpoint-dir', work_dir, '--no-resume',
+                                                '--history-file', os.path.join(work_dir, 'phase_history.json'),
+                                                '--preflight-cache-file', os.path.join(work_dir, 'preflight.json'),
+                                                '--instance-type', instance_type, *extra_arguments])
+
+    def run_from_zero():
+        virtual_now.set(0.0)
+        return resize_instances.run_pipeline(clients, pipeline_id, instance_type, arguments)
+
+    summary = contextvars.copy_context().run(run_from_zero)
+    summary['nodes'] = cluster_size
+    return summary
+
+
+def latency_override(value):
+    name, _, seconds = value.partition('=')
+    if name not in DEFAULT_LATENCIES:
+        raise argparse.ArgumentTypeError(f'Unknown latency {name!r}, choose from {sorted(DEFAULT_LATENCIES)}.')
+    try:
+        return name, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid seconds in {value!r}.')
+
+
+def set_arguments():
+    """ Defines the list of arguments that can be passed to the benchmark """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', nargs='+', type=int, default=[2, 4, 8, 16, 32, 50],
+                        help="Cluster sizes (number of nodes) to simulate.")
+    parser.add_argument('-l', '--latency', nargs='+', type=latency_override, default=[], metavar='NAME=SECONDS',
+                        help=f"Override simulated latencies: {', '.join(sorted(DEFAULT_LATENCIES))}.")
+    parser.add_argument('-type', '--instance-type', default='m5.4xlarge', choices=resize_instances.INSTANCE_TYPES,
+                        help="Target instance type, the simulated instances start as m5.2xlarge.")
+    parser.add_argument('-rolling', '--rolling', action='store_true',
+                        help="Simulate the rolling cutover instead of the full one.")
+    parser.add_argument('-batch', '--batch-size', type=int, default=1, help="Workers per batch with --rolling.")
+    parser.add_argument('-reserve', '--capacity-reservation', action='store_true',
+                        help="Reserve the capacity before the simulated cutover.")
+    parser.add_argument('-j', '--json', action='store_true', help="Print the results as JSON.")
+    parser.add_argument('-log', '--logging-level', default='WARNING', choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Logging level of resize_instances during the runs.")
+
+    return parser.parse_args()
+
+
+def get_phase_durations(summary):
+    # Per-instance tasks and rolling batches are shown by kind (see resize_instances.get_phase_kind), as the
+    # slowest of that kind.
+    phase_durations = {}
+    for name, duration in summary['metrics']['phases'].items():
+        kind = resize_instances.get_phase_kind(name)
+        phase_durations[kind] = max(phase_durations.get(kind, 0), duration)
+
+    return phase_durations
+
+
+def print_results(summaries):
+    phase_names = []
+    for summary in summaries:
+        phase_names += [name for name in get_phase_durations(summary) if name not in phase_names]
+
+    print(f'{"nodes":>5} {"status":>9} {"cutover (s)":>11} {"api calls":>9} {"throttled (s)":>13}  ' +
+          '  '.join(f'{name:>{max(len(name), 7)}}' for name in phase_names))
+    for summary in summaries:
+        phases = get_phase_durations(summary)
+        print(f'{summary["nodes"]:>5} {summary["status"]:>9} {summary["duration"]:>11.1f} '
+              f'{sum(summary["metrics"]["api_calls"].values()):>9} '
+              f'{sum(summary["metrics"]["api_throttle_wait"].values()):>13.1f}  ' +
+              '  '.join(f'{phases.get(name, 0):>{max(len(name), 7)}.1f}' for name in phase_names))
+
+
+def main():
+    arguments = set_arguments()
+    latencies = dict(DEFAULT_LATENCIES, **dict(arguments.latency))
+    logging.basicConfig(level=arguments.logging_level, format='%(levelname)s - %(message)s')
+    resize_instances.logger = logging.getLogger('resize_instances')
+    install_virtual_clock()
+
+    extra_arguments = ['--rolling', '--batch-size', str(arguments.batch_size)] if arguments.rolling else []
+    if arguments.capacity_reservation:
+        extra_arguments.append('--capacity-reservation')
+    with tempfile.TemporaryDirectory() as work_dir:
+        summaries = [run_benchmark(cluster_size, latencies, arguments.instance_type, work_dir, extra_arguments)
+                     for cluster_size in arguments.sizes]
+
+    if arguments.json:
+        print(json.dumps([{
+            'nodes': summary['nodes'],
+            'status': summary['status'],
+            'error': summary['error'],
+            'cutover_seconds': summary['duration'],
+            'api_calls': summary['metrics']['api_calls'],
+            'api_throttle_wait': summary['metrics']['api_throttle_wait'],
+            'phases': summary['metrics']['phases']
+        } for summary in summaries], indent=2, default=str))
+    else:
+        print_results(summaries)
+
+
+if __name__ == "__main__":
+    main()
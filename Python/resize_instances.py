@@ -10,19 +10,57 @@
     11/21/2020 Mikael Sikora
 '''
 
+# boto3, botocore.config and watchtower are imported where they are first needed, so --help and argument errors
+# return without loading them.  botocore.exceptions is cheap and needed by the except clauses.
 import argparse
-import boto3
-from botocore.exceptions import ClientError
-from botocore.exceptions import WaiterError
+import atexit
+from botocore.exceptions import BotoCoreError, ClientError, WaiterError
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+import contextvars
+from functools import lru_cache, partial
+import json
 import logging
+import logging.handlers
+import math
 import os
-import requests
+import queue
+import socket
+import statistics
 import sys
+import threading
 import time
-import watchtower
+import urllib.error
+import urllib.request
 
 
-def set_arguments():
+INSTANCE_TYPES = ['m5.2xlarge', 'm5.4xlarge', 'r5.8xlarge', 'z1d.6xlarge']
+
+
+def pipeline_spec(value):
+    """ Parses a PIPELINE_ID[:INSTANCE_TYPE] argument into a (pipeline_id, instance_type or None) tuple """
+    pipeline_id, _, instance_type = value.strip().partition(':')
+    if not pipeline_id:
+        raise argparse.ArgumentTypeError(f'Missing pipeline id in {value!r}.')
+    if instance_type and instance_type not in INSTANCE_TYPES:
+        raise argparse.ArgumentTypeError(f'Invalid instance type {instance_type!r} for pipeline {pipeline_id}, '
+                                         f'choose from {INSTANCE_TYPES}.')
+    return pipeline_id, instance_type or None
+
+
+def positive_int(value):
+    """ Parses an integer argument that must be at least 1 """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid integer {value!r}.')
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{number} must be at least 1.')
+    return number
+
+
+def set_arguments(argv=None):
     """ Defines the list of arguments that can be passed to the routine """
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', "--bucket", default='othello-prod', help="Name of the S3 bucket for SSM documents.",
@@ -36,29 +74,233 @@ def set_arguments():
     parser.add_argument('-r', "--region-name", default='us-west-2', help="Name of the target AWS region.",
                         choices=['us-west-2', 'us-east-2'])
     parser.add_argument('-type', "--instance-type", default='m5.2xlarge', help="Set Repository AWS instance type.",
-                        choices=['m5.2xlarge', 'm5.4xlarge', 'r5.8xlarge', 'z1d.6xlarge'])
+                        choices=INSTANCE_TYPES)
+    parser.add_argument('-pipes', "--pipeline-ids", nargs='+', type=pipeline_spec, metavar='PIPELINE_ID[:INSTANCE_TYPE]',
+                        help="Resize several pipelines concurrently.  Pipelines without a type use --instance-type.")
+    parser.add_argument('-pipefile', "--pipeline-file",
+                        help="File with one PIPELINE_ID[:INSTANCE_TYPE] per line ('#' starts a comment), same as --pipeline-ids.")
+    parser.add_argument('-c', "--max-concurrency", type=int, default=4,
+                        help="Maximum number of pipelines resized at the same time.")
+    parser.add_argument('-ckpt', "--checkpoint-dir", default=os.path.join(os.path.expanduser('~'), '.resize_instances'),
+                        help="Directory for the per-pipeline checkpoints used to resume a failed run.")
+    parser.add_argument('-fresh', "--no-resume", action='store_true',
+                        help="Ignore any checkpoint and run every phase from the beginning.")
+    parser.add_argument('-metrics', "--metrics-file",
+                        help="Append the per-pipeline timing metrics to this file as JSON lines.")
+    parser.add_argument('-plan', "--plan", action='store_true',
+                        help="Only discover the stack and print the planned actions and estimated downtime, "
+                             "without changing anything.")
+    parser.add_argument('-tsm', "--tsm-topology", action='store_true',
+                        help="Ask TSM on the primary which nodes run the repository instead of relying on the "
+                             "tableau-repository tag.")
+    parser.add_argument('-namesort', "--allow-name-sort", action='store_true',
+                        help="When the service-role or tableau-repository tags are missing, fall back to guessing "
+                             "the roles from the instance names instead of aborting.")
+    parser.add_argument('-hist', "--history-file",
+                        default=os.path.join(os.path.expanduser('~'), '.resize_instances', 'phase_history.json'),
+                        help="Phase timings of previous runs, used by --plan to estimate the downtime.")
+    parser.add_argument('-rolling', "--rolling", action='store_true',
+                        help="Resize the workers a batch at a time while the rest of the cluster keeps serving, "
+                             "then the primary last.")
+    parser.add_argument('-batch', "--batch-size", type=positive_int, default=1,
+                        help="Number of workers resized together in --rolling mode.")
+    parser.add_argument('-pfcache', "--preflight-cache-file",
+                        default=os.path.join(os.path.expanduser('~'), '.resize_instances', 'preflight_cache.json'),
+                        help="Cache of the instance type offerings, vCPU counts and quota checked before a cutover.")
+    parser.add_argument('-pfttl', "--preflight-cache-ttl", type=int, default=21600,
+                        help="Seconds the preflight lookups are cached for, 0 to always look them up.")
+    parser.add_argument('-reserve', "--capacity-reservation", action='store_true',
+                        help="Reserve on-demand capacity for the new instance type before stopping anything, "
+                             "and release it once the cutover is done.")
+
+    return parser.parse_args(argv)
+
+
+def get_pipeline_specs(args):
+    # Returns the list of (pipeline_id, instance_type) to resize.  --pipeline-ids and --pipeline-file add up,
+    # --pipeline-id is only used when neither is given.
+    pipeline_specs = list(args.pipeline_ids or [])
+    if args.pipeline_file:
+        with open(args.pipeline_file) as pipeline_file:
+            for line in pipeline_file:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    try:
+                        pipeline_specs.append(pipeline_spec(line))
+                    except argparse.ArgumentTypeError as e:
+                        raise ValueError(f'{args.pipeline_file}: {e}')
+    if not pipeline_specs:
+        pipeline_specs = [(args.pipeline_id, None)]
+
+    return [(pipeline_id, instance_type or args.instance_type) for pipeline_id, instance_type in pipeline_specs]
+
+
+logger = logging.getLogger(__name__)
+
+# Records waiting to be written by the log listener thread.  When the queue is full new records are dropped rather
+# than blocking the cutover.
+LOG_QUEUE_SIZE = 10000
+# CloudWatch batches are sent every LOG_SEND_INTERVAL seconds or as soon as they reach LOG_BATCH_SIZE bytes.
+LOG_SEND_INTERVAL = 15
+LOG_BATCH_SIZE = 256 * 1024
+# Log events CloudWatch could not take are appended here, one JSON document per line.
+LOG_SPILL_DIR = os.path.join(os.path.expanduser('~'), '.resize_instances', 'logs')
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the logging thread: a full queue drops the record, and records are queued unformatted so that
+    # large payloads passed as logging arguments are only formatted by the listener thread.
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_records = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+
+class SpillingLogsClient:
+    # Wraps the CloudWatch Logs client used by watchtower.  When put_log_events fails for any reason other than a
+    # missing stream (which watchtower handles by creating it), the events are appended to a local file instead of
+    # being lost.  Everything else is passed through to the real client.
+    def __init__(self, logs_client, spill_dir):
+        self.logs_client = logs_client
+        self.spill_dir = spill_dir
+        self.spill_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.logs_client, name)
+
+    def put_log_events(self, **kwargs):
+        try:
+            return self.logs_client.put_log_events(**kwargs)
+        except self.logs_client.exceptions.ResourceNotFoundException:
+            raise
+        except (BotoCoreError, ClientError) as e:
+            self.spill(kwargs['logStreamName'], kwargs['logEvents'], e)
+            return {}
+
+    def spill(self, log_stream_name, log_events, error):
+        spill_path = os.path.join(self.spill_dir, f'{log_stream_name}.log')
+        with self.spill_lock:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(spill_path, 'a') as spill_file:
+                for log_event in log_events:
+                    spill_file.write(json.dumps(log_event) + '\n')
+        sys.stderr.write(f'CloudWatch unreachable ({error}), {len(log_events)} log events written to {spill_path}\n')
+
+
+def get_cloudwatch_handler(session, log_stream_name, spill_dir):
+    # Returns the watchtower handler, or a file handler in spill_dir when CloudWatch cannot even be reached to set
+    # up the log group.  Tight timeouts so an unreachable endpoint costs seconds, not minutes.
+    import watchtower
+    from botocore.config import Config
+
+    logs_client = session.client('logs', config=Config(connect_timeout=3, read_timeout=10,
+                                                       retries={'max_attempts': 2}))
+    try:
+        return watchtower.CloudWatchLogHandler(
+            boto3_client=SpillingLogsClient(logs_client, spill_dir),
+            log_group_name='TableauCutover',
+            log_stream_name=log_stream_name,
+            send_interval=LOG_SEND_INTERVAL,
+            max_batch_size=LOG_BATCH_SIZE
+        )
+    except (BotoCoreError, ClientError) as e:
+        os.makedirs(spill_dir, exist_ok=True)
+        spill_path = os.path.join(spill_dir, f'{log_stream_name}.log')
+        sys.stderr.write(f'CloudWatch unreachable ({e}), logging to {spill_path}\n')
+        file_handler = logging.FileHandler(spill_path)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'))
+        return file_handler
+
 
-    return parser.parse_args()
+def stop_log_listener(listener, queue_handler):
+    listener.stop()
+    if queue_handler.dropped_records:
+        sys.stderr.write(f'Log queue full, {queue_handler.dropped_records} log records were dropped.\n')
 
 
-def init_logging(log_level, session):
-    log_format = '%(asctime)s - %(levelname)s - %(message)s'
+def init_logging(log_level, session, cloudwatch=True, spill_dir=LOG_SPILL_DIR):
+    # The module logger only puts records on a bounded queue.  A listener thread formats them and hands them to the
+    # console and CloudWatch handlers, so log I/O never runs on the cutover threads.
+    log_format = '%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=log_level, format=log_format)
     global logger
     logger = logging.getLogger(__name__)
-    logger.addHandler(watchtower.CloudWatchLogHandler(
-        boto3_session=session,
-        log_group='TableauCutover',
-        stream_name=f'{time.strftime("%Y-%m-%d_%H-%M-%S")}__{os.path.basename(__file__)}',
-        send_interval=15
-    ))
+    logger.setLevel(log_level)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(log_format))
+    handlers = [console_handler]
+    if cloudwatch:
+        log_stream_name = f'{time.strftime("%Y-%m-%d_%H-%M-%S")}__{os.path.basename(__file__)}'
+        handlers.append(get_cloudwatch_handler(session, log_stream_name, spill_dir))
+
+    queue_handler = BoundedQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Registered after the logging module's own shutdown hook, so it runs first: the queue is drained before
+    # logging.shutdown() flushes and closes the CloudWatch handler.
+    atexit.register(stop_log_listener, listener, queue_handler)
+
+
+IMDS_ENDPOINT = 'http://169.254.169.254'
+IMDS_TOKEN_TTL = 21600
+# Seconds allowed for each connect and read of the instance metadata service, so a hung IMDS cannot stall the run.
+IMDS_TIMEOUT = 2
+imds_lock = threading.Lock()
+imds_token = {'value': None, 'expires': 0}
+
+
+def get_imds_token(refresh=False):
+    # IMDSv2 session token, reused until shortly before it expires.  Returns None when the token endpoint is not
+    # available, in which case the requests fall back to IMDSv1.
+    with imds_lock:
+        if refresh or time.time() >= imds_token['expires']:
+            request = urllib.request.Request(f'{IMDS_ENDPOINT}/latest/api/token', method='PUT',
+                                             headers={'X-aws-ec2-metadata-token-ttl-seconds': str(IMDS_TOKEN_TTL)})
+            try:
+                with urllib.request.urlopen(request, timeout=IMDS_TIMEOUT) as response:
+                    imds_token['value'] = response.read().decode()
+            except (urllib.error.URLError, socket.timeout) as e:
+                # Also a timeout, e.g. when the hop limit of 1 drops the PUT response on its way into a container.
+                logger.debug(f'IMDSv2 token not available, falling back to IMDSv1: {e}')
+                imds_token['value'] = None
+            imds_token['expires'] = time.time() + IMDS_TOKEN_TTL - 60
+
+        return imds_token['value']
+
+
+def get_instance_metadata(path):
+    # Returns the body of an instance metadata path, retrying once with a new token if the token was rejected.
+    for refresh in [False, True]:
+        token = get_imds_token(refresh)
+        request = urllib.request.Request(f'{IMDS_ENDPOINT}{path}',
+                                         headers={'X-aws-ec2-metadata-token': token} if token else {})
+        try:
+            with urllib.request.urlopen(request, timeout=IMDS_TIMEOUT) as response:
+                return response.read().decode()
+        except urllib.error.HTTPError as e:
+            if e.code != 401 or refresh:
+                raise
+
+
+@lru_cache(maxsize=None)
+def get_instance_identity_document():
+    # Fetched once per process and shared by get_region() and get_current_ec2().
+    return json.loads(get_instance_metadata('/latest/dynamic/instance-identity/document'))
 
 
 def get_region():
-    r = requests.get(
-        'http://169.254.169.254/latest/dynamic/instance-identity/document')
-    response_json = r.json()
-    return response_json.get('region')
+    return get_instance_identity_document().get('region')
 
 
 def configure_session(args):
@@ -67,6 +309,8 @@ def configure_session(args):
     else:
         region_name = args.region_name
 
+    import boto3
+
     if args.local_mode:
         session = boto3.Session(region_name=region_name,
                                 profile_name=args.profile_name)
@@ -76,18 +320,240 @@ def configure_session(args):
     return session
 
 
-def create_client(session, client_type):
-    return session.client(client_type)
+# Attempts per API call, including the first.  botocore's standard retry mode retries throttles and transient
+# errors with jittered exponential backoff and fails fast on everything else.
+API_MAX_ATTEMPTS = 10
+
+# Client side rate limits as (calls per second, burst) per API, below the EC2 and SSM account limits so that
+# parallel cutovers, and other tools in the account, are not throttled.
+API_RATE_LIMITS = {
+    'ec2.DescribeInstances': (20, 50),
+    'ec2.DescribeInstanceStatus': (20, 50),
+    'ec2.StopInstances': (5, 10),
+    'ec2.StartInstances': (5, 10),
+    'ec2.ModifyInstanceAttribute': (5, 10),
+    'ssm.SendCommand': (5, 10),
+    'ssm.ListCommandInvocations': (10, 20),
+    'ssm.GetCommandInvocation': (10, 20),
+    'ssm.DescribeInstanceInformation': (10, 20),
+    'logs.DescribeLogStreams': (2, 5),
+    'logs.GetLogEvents': (10, 20)
+}
+DEFAULT_API_RATE_LIMIT = (10, 20)
+
+# Error codes of a throttled call, as opposed to a hard failure.
+THROTTLING_ERROR_CODES = ['RequestLimitExceeded', 'ThrottlingException', 'Throttling', 'ThrottledException',
+                          'TooManyRequestsException', 'RequestThrottledException', 'RequestThrottled']
+
+
+# Upper bound of the threads running the tasks of one cutover; most of them only wait on EC2 or SSM.
+MAX_TASK_WORKERS = 64
+
+
+def get_client_config(max_concurrency=1):
+    from botocore.config import Config
+
+    # The clients are shared by all pipelines, and each pipeline makes its calls from its own thread plus up to
+    # MAX_TASK_WORKERS task threads, so size the connection pool for all of them.
+    return Config(max_pool_connections=(MAX_TASK_WORKERS + 1) * max_concurrency,
+                  retries={'mode': 'standard', 'max_attempts': API_MAX_ATTEMPTS})
+
+
+def is_throttling_error(error):
+    # A throttle that is still failing after all the retries must stop the step instead of skipping an instance.
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class TokenBucket:
+    # Allows burst calls at once, refilled at rate calls per second.  A caller takes its token right away, even
+    # if that makes the bucket negative, and sleeps outside the lock until it is due, so callers are served in order.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Returns the seconds waited for the token.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time:
+            time.sleep(wait_time)
+        return wait_time
+
+
+# One bucket per API for the whole process, shared by every client and pipeline since the account limits are.
+api_rate_limiters = {}
+api_rate_limiters_lock = threading.Lock()
+
+
+def get_api_rate_limiter(api_name):
+    with api_rate_limiters_lock:
+        if api_name not in api_rate_limiters:
+            api_rate_limiters[api_name] = TokenBucket(*API_RATE_LIMITS.get(api_name, DEFAULT_API_RATE_LIMIT))
+        return api_rate_limiters[api_name]
+
+
+def create_client(session, client_type, config=None):
+    return instrument_client(session.client(client_type, config=config))
+
+
+class ClientCache(dict):
+    # Used as the clients dict: clients["ec2_client"] creates the ec2 client on first use, so a run only pays for
+    # the clients it actually needs, and clients["service_quotas_client"] the service-quotas one.  Sessions are not
+    # thread safe, hence the lock.
+    def __init__(self, session, config=None):
+        super().__init__()
+        self.session = session
+        self.config = config
+        self.lock = threading.Lock()
+
+    def __missing__(self, key):
+        with self.lock:
+            if key not in self:
+                self[key] = create_client(self.session, key[:-len('_client')].replace('_', '-'), self.config)
+            return dict.__getitem__(self, key)
+
+
+# Metrics of the pipeline being resized in the current context, see new_run_metrics().  Work handed to other
+# threads must go through submit_with_context() so its API calls and phases are counted for the same pipeline.
+current_metrics = contextvars.ContextVar('current_metrics', default=None)
+metrics_lock = threading.Lock()
+
+
+def new_run_metrics(pipeline_id):
+    run_metrics = {
+        'pipeline_id': pipeline_id,
+        'start_time': time.time(),
+        'duration': None,
+        'phases': {},
+        'api_calls': {},
+        'api_retries': {},
+        'api_errors': {},
+        'api_duration': {},
+        'api_throttle_wait': {}
+    }
+    current_metrics.set(run_metrics)
+    return run_metrics
+
+
+def submit_with_context(executor, function, *args, **kwargs):
+    return executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+def add_metric(section, name, value):
+    run_metrics = current_metrics.get()
+    if run_metrics is not None:
+        with metrics_lock:
+            run_metrics[section][name] = run_metrics[section].get(name, 0) + value
+
+
+@contextmanager
+def timed_phase(phase_name):
+    # Adds the wall-clock time spent in the block to the phase, also when the block raises.
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - start_time
+        add_metric('phases', phase_name, duration)
+        logger.debug(f'Phase {phase_name} took {duration:.1f} seconds.')
+
+
+def limit_api_call_rate(model, **kwargs):
+    api_name = f'{model.service_model.service_name}.{model.name}'
+    wait_time = get_api_rate_limiter(api_name).acquire()
+    if wait_time:
+        add_metric('api_throttle_wait', api_name, wait_time)
+
+
+def record_api_call_start(context, **kwargs):
+    context['metrics_start_time'] = time.monotonic()
+
+
+def record_api_call(model, context, parsed=None, **kwargs):
+    api_name = f'{model.service_model.service_name}.{model.name}'
+    add_metric('api_calls', api_name, 1)
+    if 'metrics_start_time' in context:
+        add_metric('api_duration', api_name, time.monotonic() - context['metrics_start_time'])
+    if parsed:
+        add_metric('api_retries', api_name, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+        if 'Error' in parsed:
+            add_metric('api_errors', api_name, 1)
+
+
+def instrument_client(client):
+    # Rate limits and counts every API call made through the client, including those of its paginators and
+    # waiters.  The rate limit comes first so the time waiting for a token is not counted as API duration.
+    client.meta.events.register('before-call.*.*', limit_api_call_rate)
+    client.meta.events.register('before-call.*.*', record_api_call_start)
+    client.meta.events.register('after-call.*.*', record_api_call)
+    return client
+
+
+def get_phase_kind(phase_name):
+    # Per-instance tasks and rolling batches are reported and estimated together: stop_instance:<name> ->
+    # stop_instance, rolling_batch_<n> -> rolling_batch.
+    phase_kind = phase_name.split(':')[0]
+    if phase_kind.startswith('rolling_batch_'):
+        return 'rolling_batch'
+    return phase_kind
+
+
+def get_emf_document(run_metrics, namespace='TableauCutover'):
+    # CloudWatch Embedded Metric Format: CloudWatch Logs extracts these as metrics with a Pipeline dimension.
+    metric_values = {
+        'CutoverDuration': run_metrics['duration'],
+        'ApiCalls': sum(run_metrics['api_calls'].values()),
+        'ApiRetries': sum(run_metrics['api_retries'].values()),
+        'ApiErrors': sum(run_metrics['api_errors'].values())
+    }
+    # Per-instance tasks and rolling batches are published by kind, as the slowest of the kind, so the number of
+    # metrics does not grow with the cluster.
+    for phase_name, duration in run_metrics['phases'].items():
+        metric_name = f'{get_phase_kind(phase_name)}Duration'
+        metric_values[metric_name] = max(metric_values.get(metric_name, 0), duration)
+
+    emf_document = {
+        '_aws': {
+            'Timestamp': int(run_metrics['start_time'] * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [['Pipeline']],
+                'Metrics': [{'Name': name, 'Unit': 'Count' if name.startswith('Api') else 'Seconds'}
+                            for name in metric_values]
+            }]
+        },
+        'Pipeline': str(run_metrics['pipeline_id'])
+    }
+    emf_document.update({name: round(value, 3) for name, value in metric_values.items()})
+
+    return emf_document
+
+
+def set_run_metric(name, value):
+    run_metrics = current_metrics.get()
+    if run_metrics is not None:
+        run_metrics[name] = value
 
 
-def get_ec2_resource(session):
-    return session.resource('ec2')
+def emit_run_metrics(run_metrics, metrics_file=None):
+    metrics_json = json.dumps(run_metrics, default=str, sort_keys=True)
+    logger.info(f'Cutover metrics: {metrics_json}')
+    # Logged on its own so the CloudWatch log event is exactly the EMF JSON document.
+    logger.info(json.dumps(get_emf_document(run_metrics)))
+    if metrics_file:
+        with metrics_lock, open(metrics_file, 'a') as metrics_output:
+            metrics_output.write(metrics_json + '\n')
 
 
 def get_current_ec2():
-    response = requests.get("http://169.254.169.254/latest/dynamic/instance-identity/document")
-    response_json = response.json()
-    return response_json.get('instanceId')
+    return get_instance_identity_document().get('instanceId')
 
 
 def get_parameter(ssm_client, param_name):
@@ -95,94 +561,194 @@ def get_parameter(ssm_client, param_name):
     return param_name['Parameters'][0]['Value']
 
 
-def list_instances_by_tag_value(ec2_client, tagkey, tagvalue):
-    # When passed a tag key, tag value this will return a list of
-    # InstanceIds that were found.
-    instance_list = []
-    try:
-        response = ec2_client.describe_instances(
-            Filters=[{
-                    'Name': f'tag:{tagkey}',
-                    'Values': [tagvalue]}])
-        for reservation in response["Reservations"]:
-            for instance in reservation["Instances"]:
-                instance_id = instance["InstanceId"]
-                for tag in instance["Tags"]:
-                    if tag["Key"] == "Name":
-                        instance_name = tag["Value"]
-                instance_list.append([instance_id, instance_name])
-    except ClientError as e:
-        logger.error(f'ClientError while trying to list instances by tag value:\n{e}')
+# Compact view of one instance of the stack, fetched in bulk once and reused by every step.  Being a tuple, the
+# first two elements stay compatible with the [instance_id, instance_name] lists used throughout this module.
+InstanceRecord = namedtuple('InstanceRecord', ['instance_id', 'name', 'service_role', 'state', 'instance_status',
+                                               'system_status', 'instance_type', 'repository', 'private_dns_name',
+                                               'private_ip_address', 'availability_zone'])
 
-    return instance_list
+# Tags describing the Tableau role of an instance.  service-role is primary or worker, the repository tag marks the
+# nodes running the Tableau repository (pgsql) process.
+ROLE_TAG_KEY = 'service-role'
+PRIMARY_ROLE = 'primary'
+REPOSITORY_TAG_KEY = 'tableau-repository'
+REPOSITORY_TAG_VALUES = ['true', 'yes', '1', 'active', 'passive']
 
+# describe_instance_status accepts at most 100 InstanceIds per call.
+DESCRIBE_INSTANCE_STATUS_CHUNK = 100
 
-def get_all_instances_status(ec2_client, instances):
-    all_instances_status = []
-    try:
-        for this_instance in instances:
-            instance_id = this_instance[0]
-            response = ec2_client.describe_instance_status(
-                InstanceIds=[str(instance_id)],
-                IncludeAllInstances=True)
-            instance_status = response['InstanceStatuses'][0]['InstanceStatus']['Status']
-            system_status = response['InstanceStatuses'][0]['SystemStatus']['Status']
-            all_instances_status.append([instance_id, instance_status, system_status])
-    except ClientError as e:
-        logger.error(f'ClientError while trying to get all instances status:\n{e}')
+
+def get_tag_value(instance, tagkey, default=None):
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == tagkey:
+            return tag['Value']
+
+    return default
+
+
+def describe_instances_paginated(ec2_client, **kwargs):
+    paginator = ec2_client.get_paginator('describe_instances')
+    for page in paginator.paginate(**kwargs):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield instance
+
+
+def describe_instances_status_paginated(ec2_client, instance_ids):
+    # Returns {instance_id: (instance_status, system_status)} for all instance_ids, including stopped instances.
+    all_instances_status = {}
+    paginator = ec2_client.get_paginator('describe_instance_status')
+    for i in range(0, len(instance_ids), DESCRIBE_INSTANCE_STATUS_CHUNK):
+        for page in paginator.paginate(InstanceIds=instance_ids[i:i + DESCRIBE_INSTANCE_STATUS_CHUNK],
+                                       IncludeAllInstances=True):
+            for status in page['InstanceStatuses']:
+                all_instances_status[status['InstanceId']] = (status['InstanceStatus']['Status'],
+                                                              status['SystemStatus']['Status'])
 
     return all_instances_status
 
 
-def get_instance_state(ec2_resource, instance_id, instance_name):
+def build_inventory(ec2_client, described_instances):
+    described_instances = list(described_instances)
+    all_instances_status = describe_instances_status_paginated(
+        ec2_client, [instance['InstanceId'] for instance in described_instances])
+
+    inventory = []
+    for instance in described_instances:
+        instance_id = instance['InstanceId']
+        instance_status, system_status = all_instances_status.get(instance_id, (None, None))
+        inventory.append(InstanceRecord(
+            instance_id=instance_id,
+            name=get_tag_value(instance, 'Name', instance_id),
+            service_role=get_tag_value(instance, ROLE_TAG_KEY),
+            state=instance['State']['Name'],
+            instance_status=instance_status,
+            system_status=system_status,
+            instance_type=instance['InstanceType'],
+            repository=get_tag_value(instance, REPOSITORY_TAG_KEY),
+            private_dns_name=instance.get('PrivateDnsName'),
+            private_ip_address=instance.get('PrivateIpAddress'),
+            availability_zone=instance.get('Placement', {}).get('AvailabilityZone')))
+
+    return inventory
+
+
+def get_stack_inventory(ec2_client, tagkey, tagvalue):
+    # When passed a tag key, tag value this will return an InstanceRecord for every instance found (terminated
+    # instances excluded), using one paginated describe_instances and one bulk describe_instance_status.
+    inventory = []
     try:
-        instance = ec2_resource.Instance(instance_id)
-        instance_state = instance.state.get('Name')
-        logger.info(f'Instance {instance_name} is {instance_state}.')
+        described_instances = describe_instances_paginated(
+            ec2_client,
+            Filters=[{
+                'Name': f'tag:{tagkey}',
+                'Values': [tagvalue]
+            }, {
+                'Name': 'instance-state-name',
+                'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+            }])
+        inventory = build_inventory(ec2_client, described_instances)
     except ClientError as e:
-        logger.error(f'ClientError while trying to get an instance state for {instance_id}:\n{e}')
+        if is_throttling_error(e):
+            raise
+        logger.error(f'ClientError while trying to get the inventory for {tagkey}={tagvalue}:\n{e}')
 
-    return instance_state
+    return inventory
 
 
-def get_all_instances_state(ec2_resource, instances):
-    all_instances_state = []
+def refresh_inventory(ec2_client, instances):
+    # Re-describe the given instances (records or [instance_id, instance_name] lists) in bulk, keeping their order.
+    inventory = []
+    instance_ids = [this_instance[0] for this_instance in instances]
     try:
-        for this_instance in instances:
-            instance_id = this_instance[0]
-            instance = ec2_resource.Instance(instance_id)
-            instance_state = instance.state.get('Name')
-            all_instances_state.append([instance_id, instance_state])
+        described_instances = {instance['InstanceId']: instance
+                               for instance in describe_instances_paginated(ec2_client, InstanceIds=instance_ids)}
+        inventory = build_inventory(ec2_client, [described_instances[instance_id] for instance_id in instance_ids
+                                                 if instance_id in described_instances])
     except ClientError as e:
-        logger.error(f'ClientError while trying to get all instances state:\n{e}')
+        if is_throttling_error(e):
+            raise
+        logger.error(f'ClientError while trying to refresh the inventory for {instance_ids}:\n{e}')
 
-    return all_instances_state
+    return inventory
 
 
-def stop_instance(ec2_client, instance_id, instance_name):
-    try:
-        ec2_client.stop_instances(InstanceIds=[instance_id])
-        logger.info(f'Instance {instance_name} is stopping.')
-        waiter = ec2_client.get_waiter('instance_stopped')
-        waiter.wait(InstanceIds=[instance_id])
-        logger.info(f'Instance {instance_name} is stopped.')
-    except WaiterError as e:
-        logger.error(f'WaitError while trying to stop instance {instance_id}:\n{e}')
-    except ClientError as e:
-        logger.error(f'ClientError while trying to stop instance {instance_id}:\n{e}')
+def get_all_instances_status(inventory):
+    return [[record.instance_id, record.instance_status, record.system_status] for record in inventory]
+
 
+def get_all_instances_state(inventory):
+    return [[record.instance_id, record.state] for record in inventory]
 
-def start_instance(ec2_client, instance_id, instance_name):
+
+def wait_for_instances(ec2_client, waiter_name, instances):
+    # Run one waiter per instance concurrently so each instance is reported as soon as it reaches the state,
+    # and the batch only takes as long as the slowest instance.  Returns the instances that failed to get there.
+    failed_instances = []
+    if not instances:
+        return failed_instances
+
+    with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        futures = {}
+        for this_instance in instances:
+            waiter = ec2_client.get_waiter(waiter_name)
+            futures[submit_with_context(executor, waiter.wait, InstanceIds=[this_instance[0]])] = this_instance
+        for future in as_completed(futures):
+            this_instance_id, this_instance_name = futures[future][0], futures[future][1]
+            try:
+                future.result()
+                logger.info(f'Instance {this_instance_name} reached {waiter_name}.')
+            except WaiterError as e:
+                logger.error(f'WaitError while waiting for {waiter_name} on instance {this_instance_id}:\n{e}')
+                failed_instances.append(futures[future])
+
+    return failed_instances
+
+
+def call_instances_batch(ec2_client, operation_name, instances):
+    # Issue a single multi-ID call (stop_instances/start_instances) for the whole batch.  If EC2 rejects the batch,
+    # e.g. one instance is in an incorrect state, fall back to one call per instance so the others still proceed.
+    operation = getattr(ec2_client, operation_name)
+    instance_ids = [this_instance[0] for this_instance in instances]
     try:
-        ec2_client.start_instances(InstanceIds=[instance_id])
-        logger.info(f'Instance {instance_name} is starting, waiting until instance_status_ok.')
-        waiter = ec2_client.get_waiter('instance_status_ok')
-        waiter.wait(InstanceIds=[instance_id])
-        logger.info(f'Instance {instance_name} is started.')
-    except WaiterError as e:
-        logger.error(f'WaitError while trying to stop instance {instance_id}:\n{e}')
+        operation(InstanceIds=instance_ids)
+        return instances, []
     except ClientError as e:
-        logger.error(f'ClientError while trying to start instance {instance_id}:\n{e}')
+        if is_throttling_error(e):
+            raise
+        logger.error(f'ClientError while trying to {operation_name} for {instance_ids}, retrying one by one:\n{e}')
+
+    accepted_instances = []
+    failed_instances = []
+    for this_instance in instances:
+        try:
+            operation(InstanceIds=[this_instance[0]])
+            accepted_instances.append(this_instance)
+        except ClientError as e:
+            if is_throttling_error(e):
+                raise
+            logger.error(f'ClientError while trying to {operation_name} for instance {this_instance[0]}:\n{e}')
+            failed_instances.append(this_instance)
+
+    return accepted_instances, failed_instances
+
+
+def stop_instances_batch(ec2_client, instances):
+    instance_names = [this_instance[1] for this_instance in instances]
+    accepted_instances, failed_instances = call_instances_batch(ec2_client, 'stop_instances', instances)
+    logger.info(f'Instances {instance_names} are stopping.')
+    failed_instances += wait_for_instances(ec2_client, 'instance_stopped', accepted_instances)
+    logger.info(f'Instances {instance_names} are stopped.')
+    return failed_instances
+
+
+def start_instances_batch(ec2_client, instances):
+    instance_names = [this_instance[1] for this_instance in instances]
+    accepted_instances, failed_instances = call_instances_batch(ec2_client, 'start_instances', instances)
+    logger.info(f'Instances {instance_names} are starting, waiting until instance_status_ok.')
+    failed_instances += wait_for_instances(ec2_client, 'instance_status_ok', accepted_instances)
+    logger.info(f'Instances {instance_names} are started.')
+    return failed_instances
 
 
 def change_instance_type(ec2_client, instance_id, instance_name, instance_type):
@@ -192,23 +758,35 @@ def change_instance_type(ec2_client, instance_id, instance_name, instance_type):
             InstanceType={'Value': instance_type})
         logger.info(f'Instance {instance_name} is changed to {instance_type}.')
     except ClientError as e:
+        if is_throttling_error(e):
+            raise
         logger.error(f'ClientError while trying to change instance {instance_id} type to {instance_type}:\n{e}')
 
 
-def get_command_invocation_response_status(ssm_client, command_id, instance_id):
+SSM_PENDING_STATUSES = ['Pending', 'InProgress', 'Delayed', 'Cancelling']
+
+
+def get_command_invocation_response_status(ssm_client, command_id, instance_id, output_streamed=False):
+    # With output_streamed a CommandOutputStreamer already logs every line, so a successful output is only logged
+    # again at DEBUG.
     response = ssm_client.get_command_invocation(
         CommandId=command_id,
         InstanceId=instance_id)
-    logger.debug(
-        f'The get_command_invocation for command_id {command_id} and instance_id {instance_id} response: {response}')
+    # Response payloads are passed as logging arguments so they are only formatted when DEBUG is enabled, and then
+    # by the log listener thread.
+    logger.debug('The get_command_invocation for command_id %s and instance_id %s response: %s',
+                 command_id, instance_id, response)
 
     response_status = response['Status']
     logger.debug(f'The response_status calculated value: {response_status}')
 
     if response_status == "Success":
         standard_output_content = response['StandardOutputContent']
-        logger.info(f'Standard output: {standard_output_content}')
-    elif response_status in ['Pending', 'InProgress', 'Delayed']:
+        if output_streamed:
+            logger.debug('Standard output: %s', standard_output_content)
+        else:
+            logger.info(f'Standard output: {standard_output_content}')
+    elif response_status in SSM_PENDING_STATUSES:
         standard_output_content = response['StandardOutputContent']
         logger.debug(f'Standard output: {standard_output_content}')
     else:
@@ -218,78 +796,350 @@ def get_command_invocation_response_status(ssm_client, command_id, instance_id):
     return response_status, standard_output_content
 
 
-def wait_for_command_invocation_success(ssm_client, command_id, instances, loop_limit=60, initial_loop_delay=60,
-                                        loop_delay=60):
-    loop_instances = instances.copy()
-    logger.info(f'Waiting for command invocation success for {command_id} on {loop_instances}.')
-    loop = 1
-    time.sleep(initial_loop_delay)
+def list_command_invocation_statuses(ssm_client, command_id):
+    # One paginated list_command_invocations call returns the status of every instance targeted by the command.
+    # Instances SSM has not registered an invocation for yet are simply missing from the result.
+    statuses = {}
+    paginator = ssm_client.get_paginator('list_command_invocations')
+    for page in paginator.paginate(CommandId=command_id):
+        for invocation in page['CommandInvocations']:
+            statuses[invocation['InstanceId']] = invocation['Status']
+
+    return statuses
+
+
+# Seconds between two reads of the command output from CloudWatch Logs while a command runs.
+OUTPUT_STREAM_POLL_INTERVAL = 5
+
+
+# SSM truncates StandardOutputContent at this many characters.
+STANDARD_OUTPUT_CONTENT_LIMIT = 24000
+
+
+class CommandOutputStreamer:
+    # Tails the CloudWatch log streams CloudWatchOutputConfig has SSM write the output of a command to, named
+    # {command_id}/{instance_id}/{step}/stdout (and stderr), on its own thread so that the status tracking never
+    # waits on the CloudWatch Logs rate limits.  Only new events are read, using the forward token of each stream,
+    # and every new line is logged as it arrives.  The output is for display; the tracking uses
+    # StandardOutputContent and only asks here for the complete stdout of an instance when SSM truncated it.  Best
+    # effort: any error only delays the output until the next poll.
+    def __init__(self, logs_client, log_group_name, command_id):
+        self.logs_client = logs_client
+        self.log_group_name = log_group_name
+        self.command_id = command_id
+        self.next_tokens = {}
+        self.standard_output = {}
+        self.poll_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(self.run,),
+                                  name=f'{threading.current_thread().name}-output', daemon=True)
+        thread.start()
+
+    def run(self):
+        while not self.stopped.wait(OUTPUT_STREAM_POLL_INTERVAL):
+            self.poll()
+        # Read what was written since the last poll.
+        self.poll()
+
+    def stop(self):
+        self.stopped.set()
+
+    def poll(self):
+        with self.poll_lock:
+            try:
+                paginator = self.logs_client.get_paginator('describe_log_streams')
+                for page in paginator.paginate(logGroupName=self.log_group_name,
+                                               logStreamNamePrefix=f'{self.command_id}/'):
+                    for log_stream in page['logStreams']:
+                        self.read_log_stream(log_stream['logStreamName'])
+            except ClientError as e:
+                # The log group or streams only exist once the first output has been written.
+                logger.debug(f'ClientError while trying to read the output of command {self.command_id}:\n{e}')
+
+    def read_log_stream(self, log_stream_name):
+        instance_id, stream_type = log_stream_name.split('/')[1], log_stream_name.split('/')[-1]
+        while True:
+            kwargs = {'logGroupName': self.log_group_name, 'logStreamName': log_stream_name, 'startFromHead': True}
+            if log_stream_name in self.next_tokens:
+                kwargs['nextToken'] = self.next_tokens[log_stream_name]
+            response = self.logs_client.get_log_events(**kwargs)
+            self.next_tokens[log_stream_name] = response['nextForwardToken']
+            if not response['events']:
+                return
+
+            for event in response['events']:
+                for line in event['message'].splitlines():
+                    if stream_type == 'stderr':
+                        logger.warning(f'{instance_id} stderr: {line}')
+                    else:
+                        logger.info(f'{instance_id}: {line}')
+                if stream_type == 'stdout':
+                    self.standard_output.setdefault(instance_id, []).append(event['message'].rstrip('\n'))
+
+    def get_standard_output(self, instance_id):
+        # Reads the streams up to now and returns the stdout of the instance, None if nothing reached CloudWatch.
+        self.poll()
+        if instance_id not in self.standard_output:
+            return None
+        return '\n'.join(self.standard_output[instance_id])
+
+
+def track_command_invocations(ssm_client, command_id, instances, timeout=3600, initial_poll_delay=0.5,
+                              max_poll_delay=15, backoff_factor=2, output_streamer=None):
+    # Generator yielding (instance_id, response_status, standard_output_content) for each instance as soon as its
+    # invocation finishes.  Polling starts sub-second and backs off while nothing changes; any status change resets
+    # the delay.  Raises if any instance is still pending when the timeout (in seconds) runs out.  With an
+    # output_streamer the output is also tailed live from CloudWatch Logs, and replaces StandardOutputContent when
+    # SSM truncated it.
+    loop_instances = list(instances)
+    deadline = time.monotonic() + timeout
+    poll_delay = initial_poll_delay
+    last_statuses = {}
+
+    if output_streamer:
+        output_streamer.start()
+    try:
+        while loop_instances:
+            statuses = list_command_invocation_statuses(ssm_client, command_id)
+            logger.debug('The list_command_invocations statuses for command_id %s: %s', command_id, statuses)
 
-    while loop <= loop_limit and loop_instances:
-        for instance_id in loop_instances:
-            response_status, standard_output_content = get_command_invocation_response_status(ssm_client, command_id,
-                                                                                              instance_id)
-            if response_status == 'Success':
-                logger.info(f'Success for {instance_id}.')
+            for instance_id in [instance_id for instance_id in loop_instances
+                                if statuses.get(instance_id, 'Pending') not in SSM_PENDING_STATUSES]:
                 loop_instances.remove(instance_id)
-            elif response_status in ['Pending', 'InProgress', 'Delayed']:
-                logger.info(f'Pending for {instance_id}.  Status is {response_status}.')
-                time.sleep(loop_delay)
+                response_status, standard_output_content = get_command_invocation_response_status(
+                    ssm_client, command_id, instance_id, output_streamed=bool(output_streamer))
+                if output_streamer and len(standard_output_content) >= STANDARD_OUTPUT_CONTENT_LIMIT:
+                    streamed_output = output_streamer.get_standard_output(instance_id)
+                    if streamed_output is not None and len(streamed_output) > len(standard_output_content):
+                        standard_output_content = streamed_output
+                    else:
+                        logger.warning(f'The output of {command_id} on {instance_id} is truncated.')
+                yield instance_id, response_status, standard_output_content
+
+            if not loop_instances:
+                break
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(f'Error for {loop_instances}.  SSM document did not return success within '
+                                f'{timeout} seconds.')
+
+            if statuses != last_statuses:
+                poll_delay = initial_poll_delay
             else:
-                raise Exception(f'Error for {instance_id}.  Status is {response_status}.')
-            loop += loop
+                poll_delay = min(poll_delay * backoff_factor, max_poll_delay)
+            last_statuses = statuses
+            logger.debug(f'Pending for {loop_instances}, polling again in {poll_delay} seconds.')
+            time.sleep(min(poll_delay, remaining))
+    finally:
+        if output_streamer:
+            output_streamer.stop()
+
+
+def wait_for_command_invocation_success(ssm_client, command_id, instances, timeout=3600, output_streamer=None):
+    # Returns {instance_id: standard_output_content}, raising on the first instance that does not succeed.
+    logger.info(f'Waiting for command invocation success for {command_id} on {instances}.')
+    all_output = {}
+    for instance_id, response_status, standard_output_content in track_command_invocations(
+            ssm_client, command_id, instances, timeout=timeout, output_streamer=output_streamer):
+        if response_status != 'Success':
+            raise Exception(f'Error for {instance_id}.  Status is {response_status}.')
+        logger.info(f'Success for {instance_id}.')
+        all_output[instance_id] = standard_output_content
+
+    return all_output
+
+
+# describe_instance_information accepts at most 50 values in the InstanceIds filter.
+DESCRIBE_INSTANCE_INFORMATION_CHUNK = 50
+
+# Prints the last boot time of a Windows instance in seconds since the epoch (UTC).
+LAST_BOOT_TIME_COMMAND = ("[int64]((Get-CimInstance Win32_OperatingSystem).LastBootUpTime.ToUniversalTime() - "
+                          "[datetime]'1970-01-01').TotalSeconds")
+
+
+def get_ssm_ping_statuses(ssm_client, instance_ids):
+    # Returns {instance_id: (ping_status, last_ping_date_time)} for the SSM managed instances among instance_ids.
+    ping_statuses = {}
+    paginator = ssm_client.get_paginator('describe_instance_information')
+    for i in range(0, len(instance_ids), DESCRIBE_INSTANCE_INFORMATION_CHUNK):
+        for page in paginator.paginate(Filters=[{
+                'Key': 'InstanceIds',
+                'Values': instance_ids[i:i + DESCRIBE_INSTANCE_INFORMATION_CHUNK]}]):
+            for information in page['InstanceInformationList']:
+                ping_statuses[information['InstanceId']] = (information['PingStatus'],
+                                                            information['LastPingDateTime'])
+
+    return ping_statuses
+
+
+def get_last_boot_times(ssm_client, instances, timeout):
+    # Returns {instance_id: last boot time in epoch seconds} for the instances that answered within timeout.
+    instance_ids = [this_instance[0] for this_instance in instances]
+    response = ssm_client.send_command(
+        InstanceIds=instance_ids,
+        DocumentName='AWS-RunPowerShellScript',
+        Parameters={
+            'executionTimeout': [str(int(timeout))],
+            'commands': [LAST_BOOT_TIME_COMMAND]
+        }
+    )
+    command_id = response['Command']['CommandId']
+
+    last_boot_times = {}
+    try:
+        for instance_id, response_status, standard_output_content in track_command_invocations(
+                ssm_client, command_id, instance_ids, timeout=timeout):
+            if response_status == 'Success':
+                try:
+                    last_boot_times[instance_id] = int(standard_output_content.strip())
+                except ValueError:
+                    logger.warning(f'Unexpected last boot time from {instance_id}: {standard_output_content}')
+    except Exception as e:
+        logger.info(f'Last boot time check {command_id} incomplete: {e}')
+        try:
+            ssm_client.cancel_command(CommandId=command_id)
+        except ClientError as e:
+            logger.debug(f'ClientError while trying to cancel command {command_id}:\n{e}')
+
+    return last_boot_times
+
+
+def wait_for_reboot_completion(clients, instances, reboot_requested_at, timeout=1800, initial_poll_delay=2,
+                               max_poll_delay=15, probe_timeout=60):
+    # Returns as soon as every instance has rebooted and is reachable again.  An instance is a candidate once its
+    # SSM agent is Online with a ping after the reboot request and its EC2 status checks are ok; it is done once
+    # its reported last boot time is after the reboot request, which rules out answers from before the restart.
+    loop_instances = list(instances)
+    deadline = time.monotonic() + timeout
+    poll_delay = initial_poll_delay
+
+    while loop_instances:
+        instance_ids = [this_instance[0] for this_instance in loop_instances]
+        ping_statuses = get_ssm_ping_statuses(clients["ssm_client"], instance_ids)
+        all_instances_status = describe_instances_status_paginated(clients["ec2_client"], instance_ids)
+        logger.debug('Reboot check ping statuses: %s, instance statuses: %s', ping_statuses, all_instances_status)
+
+        candidate_instances = []
+        for this_instance in loop_instances:
+            ping_status, last_ping_date_time = ping_statuses.get(this_instance[0], (None, None))
+            if (ping_status == 'Online' and last_ping_date_time >= reboot_requested_at
+                    and all_instances_status.get(this_instance[0]) == ('ok', 'ok')):
+                candidate_instances.append(this_instance)
+
+        remaining = deadline - time.monotonic()
+        if candidate_instances and remaining > 0:
+            last_boot_times = get_last_boot_times(clients["ssm_client"], candidate_instances,
+                                                  min(probe_timeout, remaining))
+            for this_instance in candidate_instances:
+                if last_boot_times.get(this_instance[0], 0) >= int(reboot_requested_at.timestamp()):
+                    logger.info(f'Instance {this_instance[1]} is back online after reboot.')
+                    loop_instances.remove(this_instance)
+                    poll_delay = initial_poll_delay
+
+        if not loop_instances:
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f'Instances {[this_instance[1] for this_instance in loop_instances]} did not come back '
+                            f'online within {timeout} seconds after reboot.')
+
+        time.sleep(min(poll_delay, remaining))
+        poll_delay = min(poll_delay * 2, max_poll_delay)
+
+
+# send_command accepts at most 50 InstanceIds per call.
+SEND_COMMAND_CHUNK = 50
+
+
+def send_ssm_command(ssm_client, instance_ids, document_name, parameters=None, log_group_name='TableauCutover'):
+    kwargs = {
+        'InstanceIds': instance_ids,
+        'DocumentName': document_name,
+        'CloudWatchOutputConfig': {
+            'CloudWatchLogGroupName': log_group_name,
+            'CloudWatchOutputEnabled': True
+        }
+    }
+    if parameters:
+        kwargs['Parameters'] = parameters
+    response = ssm_client.send_command(**kwargs)
+    logger.debug('The send_command %s for instances %s response: %s', document_name, instance_ids, response)
+
+    return response
+
+
+def run_ssm_command(clients, instances, document_name, parameters=None, log_group_name='TableauCutover',
+                    timeout=3600):
+    # Fan one command out to every instance (one send_command per 50 instances) and wait for all of them together,
+    # so the step costs one command's latency instead of one per instance.  Returns {instance_id: output}.
+    instance_ids = [this_instance[0] for this_instance in instances]
+    command_ids = []
+    for i in range(0, len(instance_ids), SEND_COMMAND_CHUNK):
+        chunk_instance_ids = instance_ids[i:i + SEND_COMMAND_CHUNK]
+        response = send_ssm_command(clients["ssm_client"], chunk_instance_ids, document_name, parameters,
+                                    log_group_name)
+        # Get the command_id so we check the status of the SSM commands.
+        command_ids.append((response['Command']['CommandId'], chunk_instance_ids))
+
+    if len(command_ids) == 1:
+        command_id, chunk_instance_ids = command_ids[0]
+        return wait_for_command_invocation_success(
+            clients["ssm_client"], command_id, chunk_instance_ids, timeout,
+            CommandOutputStreamer(clients["logs_client"], log_group_name, command_id))
 
-    if loop > loop_limit:
-        raise Exception(f'Error for {instance_id}.  SSM document did not return success within time limit.')
+    all_output = {}
+    with ThreadPoolExecutor(max_workers=len(command_ids)) as executor:
+        futures = [submit_with_context(executor, wait_for_command_invocation_success, clients["ssm_client"],
+                                       command_id, chunk_instance_ids, timeout,
+                                       CommandOutputStreamer(clients["logs_client"], log_group_name, command_id))
+                   for command_id, chunk_instance_ids in command_ids]
+        for future in as_completed(futures):
+            all_output.update(future.result())
 
-    return standard_output_content
+    return all_output
 
 
 def stop_and_delicense_tableau(clients, primary_instance_id, primary_instance_name, s3_bucket):
     # Issue stop command on Primary server
     # ## NEED TO PUT IN CODE TO CAPTURE "Service failed to stop properly" AND CONTINUE
     logger.info(f'Stopping Tableau Server for {primary_instance_name}.')
-    response = clients["ssm_client"].send_command(
-        InstanceIds=[primary_instance_id],
-        DocumentName='TableauServiceStop',
-        CloudWatchOutputConfig={
-            'CloudWatchLogGroupName': 'TableauCutover',
-            'CloudWatchOutputEnabled': True
-        }
-    )
-    logging.debug(f'The send_command for instances {primary_instance_id} response: {response}')
-    # Get the command_id so we check the status of the SSM commands.
-    command_id = response['Command']['CommandId']
-    wait_for_command_invocation_success(clients["ssm_client"], command_id, [primary_instance_id])
+    with timed_phase('tableau_stop'):
+        run_ssm_command(clients, [[primary_instance_id, primary_instance_name]], 'TableauServiceStop')
 
     logger.info(f'Deactivating Tableau Server licenses for {primary_instance_name}.')
-    response = clients["ssm_client"].send_command(
-        InstanceIds=[primary_instance_id],
-        DocumentName='TableauDeactivateLicenses',
-        Parameters={
-            's3Bucket': [s3_bucket]
-        },
-        CloudWatchOutputConfig={
-            'CloudWatchLogGroupName': 'TableauCutover',
-            'CloudWatchOutputEnabled': True
-        }
-    )
-    logging.debug(f'The send_command for instances {primary_instance_id} response: {response}')
-    # Get the command_id so we check the status of the SSM commands.
-    command_id = response['Command']['CommandId']
-    wait_for_command_invocation_success(clients["ssm_client"], command_id, [primary_instance_id])
+    with timed_phase('license_deactivation'):
+        run_ssm_command(clients, [[primary_instance_id, primary_instance_name]], 'TableauDeactivateLicenses',
+                        {'s3Bucket': [s3_bucket]})
 
 
-def stop_instances_and_change_instance_type(clients, ec2_resource, instance_type, instances_sorted,
-                                            instances_sorted_reduced, instances_sorted_reversed):
-    # Stop AWS instances.
-    # Using instances_sorted list to ensure that the primary server is stopped first, then workers.
-    for this_instance in instances_sorted:
-        this_instance_id = this_instance[0]
-        this_instance_name = this_instance[1]
-        logger.info(f'Stopping instance {this_instance_name}.')
-        stop_instance(clients["ec2_client"], this_instance_id, this_instance_name)
+def call_cutover_instances(clients, operation_name, instances):
+    # One stop_instances/start_instances call for an ordering group of the cutover, the per-instance wait tasks
+    # follow it.  Raises once the accepted instances are on their way if EC2 rejected any, so the task is not
+    # checkpointed and a resumed run issues the call again.
+    accepted_instances, failed_instances = call_instances_batch(clients["ec2_client"], operation_name, instances)
+    logger.info(f'{operation_name} accepted for {[this_instance[1] for this_instance in accepted_instances]}.')
+    if failed_instances:
+        raise Exception(f'EC2 rejected {operation_name} for '
+                        f'{[this_instance[1] for this_instance in failed_instances]}.')
+
+
+def wait_for_cutover_instance(clients, waiter_name, this_instance):
+    try:
+        clients["ec2_client"].get_waiter(waiter_name).wait(InstanceIds=[this_instance[0]])
+    except WaiterError as e:
+        raise Exception(f'Instance {this_instance[1]} did not reach {waiter_name}:\n{e}')
+    logger.info(f'Instance {this_instance[1]} reached {waiter_name}.')
+
+
+def stop_cutover_instance(clients, this_instance):
+    wait_for_cutover_instance(clients, 'instance_stopped', this_instance)
+
 
+def change_instances_type(clients, instance_type, instances_sorted_reduced):
     # Change instance type of the instances with repository.
     # Using instances_sorted_reduced ensures that only the instances with repository will changed.
     for this_instance in instances_sorted_reduced:
@@ -298,45 +1148,42 @@ def stop_instances_and_change_instance_type(clients, ec2_resource, instance_type
         logger.info(f'Starting instance type change to {instance_type} for {this_instance_name}.')
         change_instance_type(clients["ec2_client"], this_instance_id, this_instance_name, instance_type)
 
-    # Make sure all Worker instances are started before we start Primary, then start Primary.
-    # Using instances_sorted_reversed ensures that workers are started first, primary last.
-    for this_instance in instances_sorted_reversed:
-        this_instance_id = this_instance[0]
-        this_instance_name = this_instance[1]
-        start_instance(clients["ec2_client"], this_instance_id, this_instance_name)
 
-    # List all instance states
-    for this_instance in instances_sorted:
-        this_instance_id = this_instance[0]
-        this_instance_name = this_instance[1]
-        get_instance_state(ec2_resource, this_instance_id, this_instance_name)
+def change_and_verify_instances_type(clients, instance_type, instances):
+    # change_instances_type only logs a rejected change, so check the types before the instances are started again.
+    change_instances_type(clients, instance_type, instances)
+    unchanged_instances = [[record.instance_id, record.name]
+                           for record in refresh_inventory(clients["ec2_client"], instances)
+                           if record.instance_type != instance_type]
+    if unchanged_instances:
+        raise Exception(f'Instances {unchanged_instances} did not change to {instance_type}.')
 
 
-def bring_d_drive_online_and_reboot_servers(clients, instances_sorted_reduced):
-    # Ensure D: Drive is online for the instances with repository
-    for this_instance in instances_sorted_reduced:
-        this_instance_id = this_instance[0]
-        this_instance_name = this_instance[1]
+def start_cutover_instance(clients, this_instance):
+    wait_for_cutover_instance(clients, 'instance_status_ok', this_instance)
+    for record in refresh_inventory(clients["ec2_client"], [this_instance]):
+        logger.info(f'Instance {record.name} is {record.state} ({record.instance_type}).')
+
+
+def bring_d_drive_online(clients, instances_sorted_reduced):
+    if not instances_sorted_reduced:
+        logger.info('No instances with repository, skipping D: Drive check.')
+        return
+
+    # Ensure D: Drive is online for the instances with repository.
+    # If D: Drive is offline, bring it online; one command for all instances.
+    logger.info(f'Ensure D: Drive is online for {instances_sorted_reduced}.')
+    run_ssm_command(clients, instances_sorted_reduced, 'AWS-RunPowerShellScript', {
+        'executionTimeout': ['3600'],
+        'commands': ['Set-Disk -Number 1 -IsOffline $False', 'Set-Disk -Number 1 -IsReadonly $False']
+    })
+    logger.info(f'Completed D: Drive check for {instances_sorted_reduced}.')
 
-        # If D: Drive is offline, bring it online
-        logger.info(f'Ensure D: Drive is online for {this_instance_name} ({this_instance_id}).')
-        response = clients["ssm_client"].send_command(
-            InstanceIds=[this_instance_id],
-            DocumentName='AWS-RunPowerShellScript',
-            Parameters={
-                'executionTimeout': ['3600'],
-                'commands': ['Set-Disk -Number 1 -IsOffline $False', 'Set-Disk -Number 1 -IsReadonly $False']
-            },
-            CloudWatchOutputConfig={
-                'CloudWatchLogGroupName': 'TableauCutover',
-                'CloudWatchOutputEnabled': True
-            }
-        )
-        logging.debug(f'The send_command for instance {this_instance_id} response: {response}')
-        # Get the command_id so we check the status of the SSM commands.
-        command_id = response['Command']['CommandId']
-        wait_for_command_invocation_success(clients["ssm_client"], command_id, [this_instance_id])
-        logger.info(f'Completed D: Drive check for {this_instance_name} ({this_instance_id}).')
+
+def reboot_servers(clients, instances_sorted_reduced):
+    if not instances_sorted_reduced:
+        logger.info('No instances with repository, skipping reboot.')
+        return
 
     # Reboot the servers with instance type change, Primary and Worker 1.
     instance_ids = []
@@ -344,107 +1191,58 @@ def bring_d_drive_online_and_reboot_servers(clients, instances_sorted_reduced):
         instance_ids.append(this_instance[0])
 
     logger.info(f'Reboot Instances {instances_sorted_reduced}; (Instance IDs {instance_ids}) ).')
-    clients["ssm_client"].send_command(
-        InstanceIds=instance_ids,
-        DocumentName='AWS-RunPowerShellScript',
-        Parameters={
-            'workingDirectory': ['C:\\cookbooks\\tableau_server\\files'],
-            'executionTimeout': ['3600'],
-            'commands': ['.\\restart_computer.ps1']
-        },
-        CloudWatchOutputConfig={
-            'CloudWatchLogGroupName': 'TableauStackBuild',
-            'CloudWatchOutputEnabled': True
-        }
-    )
+    response = send_ssm_command(clients["ssm_client"], instance_ids, 'AWS-RunPowerShellScript', {
+        'workingDirectory': ['C:\\cookbooks\\tableau_server\\files'],
+        'executionTimeout': ['3600'],
+        'commands': ['.\\restart_computer.ps1']
+    }, log_group_name='TableauStackBuild')
     logger.info(f'Triggered reboot instance {instances_sorted_reduced}) via SSM.')
-    logger.info('Sleep three minutes')
-    time.sleep(60 * 3)
+    # Rather than sleeping a fixed time, wait until every rebooted instance reports a boot after this request.
+    wait_for_reboot_completion(clients, instances_sorted_reduced, response['Command']['RequestedDateTime'])
     logger.info(f'Reboot completed for {instances_sorted_reduced}).')
 
 
 def license_and_restart_tableau(clients, s3_bucket, primary_instance_id, primary_instance_name):
     # Activate licenses on Primary server
     logger.info(f'Activating Tableau Server licenses for {primary_instance_name}.')
-    response = clients["ssm_client"].send_command(
-        InstanceIds=[primary_instance_id],
-        DocumentName='TableauActivateLicenses',
-        Parameters={
-            # need to put in variable for prod or nonprod
-            's3Bucket': [s3_bucket]
-        },
-        CloudWatchOutputConfig={
-            'CloudWatchLogGroupName': 'TableauCutover',
-            'CloudWatchOutputEnabled': True
-        }
-    )
-    logging.debug(f'The send_command for instances {primary_instance_id} response: {response}')
-    # Get the command_id so we check the status of the SSM commands.
-    command_id = response['Command']['CommandId']
-    wait_for_command_invocation_success(clients["ssm_client"], command_id, [primary_instance_id])
+    with timed_phase('license_activation'):
+        run_ssm_command(clients, [[primary_instance_id, primary_instance_name]], 'TableauActivateLicenses',
+                        {'s3Bucket': [s3_bucket]})
 
     # Issue restart command on Primary TSM service to start the server
     logger.info(f'Restarting Tableau TSM Service for {primary_instance_name}.')
-    response = clients["ssm_client"].send_command(
-        InstanceIds=[primary_instance_id],
-        DocumentName='TableauServiceRestart',
-        CloudWatchOutputConfig={
-            'CloudWatchLogGroupName': 'TableauCutover',
-            'CloudWatchOutputEnabled': True
-        }
-    )
-    logging.debug(f'The send_command for instances {primary_instance_id} response: {response}')
-    # Get the command_id so we check the status of the SSM commands.
-    command_id = response['Command']['CommandId']
-    wait_for_command_invocation_success(clients["ssm_client"], command_id, [primary_instance_id])
+    with timed_phase('tableau_restart'):
+        run_ssm_command(clients, [[primary_instance_id, primary_instance_name]], 'TableauServiceRestart')
 
 
-def main():
-    arguments = set_arguments()
-    session = configure_session(arguments)
-    init_logging(arguments.logging_level, session)
-    ec2_resource = get_ec2_resource(session)
-    clients = {
-        "ec2_client": create_client(session, 'ec2'),
-        "ssm_client": create_client(session, 'ssm')
-    }
-    instance_type = arguments.instance_type
-    s3_bucket = arguments.bucket
+def plan_type_changes(instances, instance_type):
+    # Returns the instances whose current type (from the inventory) differs from the requested one, in order.
+    changed_instances = []
+    for record in instances:
+        if record.instance_type == instance_type:
+            logger.info(f'Instance {record.name} already is {instance_type}, nothing to change.')
+        else:
+            logger.info(f'Instance {record.name} will change from {record.instance_type} to {instance_type}.')
+            changed_instances.append(record)
 
-    # Get all instances with the current pipeline number.
-    stack_tag_name = "stack-pipeline-number"
-    instances = list_instances_by_tag_value(clients["ec2_client"], stack_tag_name, arguments.pipeline_id)
-    logger.info(f'instances: {instances}')
-    instances_sorted = sorted(instances, key=lambda instance: instance[1])
+    return changed_instances
 
-    # Stop Tableau Server and deactivate Tableau Server licenses
-    # Need to identify the first element of sorted list 'instances_sorted' as Primary
-    # Using first instance of instances_sorted is a cheap way to identify primary.  Ideally, one should check all
-    # instance tag "service-role" for Primary.
-    primary_instance = instances_sorted[0]
-    primary_instance_id = primary_instance[0]
-    primary_instance_name = primary_instance[1]
-    logger.info(f'Primary instance: {primary_instance}.')
-
-    # Create Worker list the cheap way
-    worker_instances = instances_sorted[1:]
-    logger.info(f'Worker instances: {worker_instances}.')
-
-    # Create list of the first two instances, Primary and Worker 1.
-    # Instances_sorted_reduced is a cheap way to identify what instances to do.  Ideally, one should check for instances
-    # with the repository installed, then do those.
-    instances_sorted_reduced = instances_sorted[:len(instances_sorted)-2]
-    logger.info(f'Instances sorted and reduced: {instances_sorted_reduced}')
-
-    # Create a reversed list, so Workers are started first, then lastly, Primary.
-    # We do this the cheap way of reversing the sorted list of instances, making Primary last.
-    instances_sorted_reversed = instances_sorted[::-1]
-    logger.info(f'Instances sorted reversed: {instances_sorted_reversed}')
 
+def check_health_and_stop_tableau(clients, instances_sorted, primary_instance_id, primary_instance_name, s3_bucket,
+                                  refresh=False):
     # Check instance health.  If healthy, then stop Tableau Server and deactivate licenses, else bypass.
-    all_instances_state = get_all_instances_state(ec2_resource, instances_sorted)
+    # The inventory already carries state and status checks, so no further EC2 calls are needed here, unless it
+    # may be stale (refresh), e.g. after the rolling batches.  Instances the refresh misses count as not OK.
+    if refresh:
+        refreshed_instances = refresh_inventory(clients["ec2_client"], instances_sorted)
+        if len(refreshed_instances) != len(instances_sorted):
+            logger.info(f'Unable to refresh the state of all instances.  '
+                        f'Bypassing Tableau Server stop and license deactivation.')
+            return
+        instances_sorted = refreshed_instances
+    all_instances_state = get_all_instances_state(instances_sorted)
     logger.info(f'Instance State: {all_instances_state}.')
-    all_instances_status = get_all_instances_status(clients["ec2_client"], instances_sorted)
+    all_instances_status = get_all_instances_status(instances_sorted)
 
     # The following creates a list (ok_instances) from values in elements 1 and 2 of nested list all_instances_status.
     # It basically scrubs the instance ids, element[0], out of the list all_instances_status.
@@ -459,22 +1257,962 @@ def main():
         logger.info(f'NOT all instances are OK: {all_instances_status}.  '
                     f'Bypassing Tableau Server stop and license deactivation.')
 
-    # Stop AWS instances, change instance type, then start instances.
-    stop_instances_and_change_instance_type(clients, ec2_resource, instance_type, instances_sorted,
-                                            instances_sorted_reduced, instances_sorted_reversed)
 
-    # Ensure D: Drive is online and reboot for the instances with repository.
-    bring_d_drive_online_and_reboot_servers(clients, instances_sorted_reduced)
+def get_checkpoint_path(checkpoint_dir, pipeline_id):
+    return os.path.join(checkpoint_dir, f'{pipeline_id}.json')
+
+
+def load_checkpoint(checkpoint_path, pipeline_id, instance_type, instances, resume=True, mode='full'):
+    # Returns the checkpoint of a previous run of the same cutover (same target type and instances), or a fresh one.
+    checkpoint = {
+        'pipeline_id': pipeline_id,
+        'instance_type': instance_type,
+        'mode': mode,
+        'instance_ids': sorted(this_instance[0] for this_instance in instances),
+        'completed_phases': []
+    }
+    if not resume or not os.path.exists(checkpoint_path):
+        return checkpoint
+
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            previous_checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError) as e:
+        logger.warning(f'Unable to read checkpoint {checkpoint_path}, starting from the beginning:\n{e}')
+        return checkpoint
+
+    if (previous_checkpoint.get('instance_type') != checkpoint['instance_type']
+            or previous_checkpoint.get('instance_ids') != checkpoint['instance_ids']):
+        logger.warning(f'Checkpoint {checkpoint_path} is for a different cutover, starting from the beginning.')
+        return checkpoint
+    # A full cutover may have left Tableau stopped and delicensed, which a rolling run does not expect (and the
+    # other way around), so a half-done cutover must be finished in the mode it started in.
+    if previous_checkpoint.get('mode', 'full') != mode and previous_checkpoint.get('completed_phases'):
+        raise Exception(f'Checkpoint {checkpoint_path} is for a {previous_checkpoint.get("mode", "full")} cutover, '
+                        f'resume it in the same mode or use --no-resume.')
+
+    logger.info(f'Resuming pipeline {pipeline_id}, completed phases: {previous_checkpoint["completed_phases"]}.')
+    checkpoint.update(previous_checkpoint)
+
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    # Write to a temporary file first so a crash never leaves a half written checkpoint behind.
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    checkpoint['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    temporary_path = f'{checkpoint_path}.tmp'
+    with open(temporary_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def clear_checkpoint(checkpoint_path):
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def run_tasks(tasks, checkpoint, checkpoint_path):
+    # Runs the (task_name, task_function, dependencies) DAG: every task starts as soon as the tasks it depends on
+    # have completed, so unrelated tasks overlap and the critical path, not the sum of the steps, sets the duration.
+    # Tasks must be listed after their dependencies.  A task is only submitted once all its dependencies are done,
+    # so no worker thread is ever held waiting for another task.  Completed tasks are checkpointed and skipped on
+    # resume.  A failed task skips the tasks depending on it while the others carry on, and the run raises once
+    # everything has settled.
+    checkpoint_lock = threading.Lock()
+
+    def run_task(task_name, task_function):
+        if task_name in checkpoint['completed_phases']:
+            logger.info(f'Skipping task {task_name}, completed by a previous run.')
+            return
+        logger.info(f'Starting task {task_name}.')
+        with timed_phase(task_name):
+            task_function()
+        with checkpoint_lock:
+            checkpoint['completed_phases'].append(task_name)
+            save_checkpoint(checkpoint_path, checkpoint)
+        logger.info(f'Completed task {task_name}.')
+
+    task_functions = {task_name: task_function for task_name, task_function, dependencies in tasks}
+    task_dependencies = {task_name: dependencies for task_name, task_function, dependencies in tasks}
+    pending_dependencies = {task_name: set(dependencies) for task_name, task_function, dependencies in tasks}
+    dependents = {task_name: [] for task_name in task_functions}
+    for task_name, task_function, dependencies in tasks:
+        for dependency_name in dependencies:
+            dependents[dependency_name].append(task_name)
+    ready_tasks = [task_name for task_name, dependencies in pending_dependencies.items() if not dependencies]
+    completed_tasks = set()
+    failed_tasks = []
+    skipped_tasks = []
+
+    def settle(task_name):
+        # Queues the dependents whose last dependency just settled, and skips those of a task that did not complete.
+        for dependent_name in dependents[task_name]:
+            pending_dependencies[dependent_name].discard(task_name)
+            if pending_dependencies[dependent_name]:
+                continue
+            incomplete_dependencies = [dependency_name for dependency_name in task_dependencies[dependent_name]
+                                       if dependency_name not in completed_tasks]
+            if incomplete_dependencies:
+                logger.error(f'Skipping task {dependent_name}, {incomplete_dependencies} did not complete.')
+                skipped_tasks.append(dependent_name)
+                settle(dependent_name)
+            else:
+                ready_tasks.append(dependent_name)
+
+    # Only this thread submits and settles tasks; the workers just run them.
+    running_tasks = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(len(tasks), MAX_TASK_WORKERS)),
+                            thread_name_prefix=threading.current_thread().name) as executor:
+        while ready_tasks or running_tasks:
+            for task_name in ready_tasks:
+                running_tasks[submit_with_context(executor, run_task, task_name, task_functions[task_name])] = task_name
+            ready_tasks.clear()
+
+            done_futures, _ = wait(running_tasks, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                task_name = running_tasks.pop(future)
+                try:
+                    future.result()
+                    completed_tasks.add(task_name)
+                except Exception as e:
+                    logger.error(f'Task {task_name} failed: {e}', exc_info=True)
+                    failed_tasks.append(task_name)
+                settle(task_name)
+
+    if failed_tasks:
+        raise Exception(f'Tasks {failed_tasks} failed, skipped {skipped_tasks}.')
+
+
+# Lists the TSM nodes with their processes; the nodes running pgsql hold the repository.
+TSM_TOPOLOGY_COMMAND = 'tsm topology list-nodes -v'
+
+
+def parse_tsm_topology(standard_output_content):
+    # Returns the host names of the nodes running pgsql from the `tsm topology list-nodes -v` output, where every
+    # "nodeN: <host>" line is followed by the indented processes of that node.
+    repository_hosts = []
+    current_host = None
+    for line in standard_output_content.splitlines():
+        stripped_line = line.strip()
+        if not stripped_line:
+            continue
+        if not line[0].isspace() and ':' in stripped_line:
+            current_host = stripped_line.split(':', 1)[1].strip().lower() or None
+        elif current_host and stripped_line.startswith('pgsql') and current_host not in repository_hosts:
+            repository_hosts.append(current_host)
+
+    return repository_hosts
+
+
+def get_tsm_repository_instances(clients, primary_instance, instances):
+    # Maps the TSM repository hosts to instances by private DNS name (short or full), private IP or Name tag.
+    output = run_ssm_command(clients, [primary_instance], 'AWS-RunPowerShellScript', {
+        'executionTimeout': ['600'],
+        'commands': [TSM_TOPOLOGY_COMMAND]
+    }, timeout=600)
+    repository_hosts = parse_tsm_topology(output[primary_instance[0]])
+
+    # Only host names have a short form, splitting a private IP on '.' would leave just its first octet.
+    instances_by_host = {}
+    for record in instances:
+        if record.private_ip_address:
+            instances_by_host[record.private_ip_address] = record
+        for host in [record.private_dns_name, record.name]:
+            if host:
+                instances_by_host[host.lower()] = record
+                instances_by_host.setdefault(host.lower().split('.')[0], record)
+
+    def get_host_instance(host):
+        if host in instances_by_host:
+            return instances_by_host[host]
+        if not host.replace('.', '').isdigit():
+            return instances_by_host.get(host.split('.')[0])
+        return None
+
+    missing_hosts = [host for host in repository_hosts if get_host_instance(host) is None]
+    if missing_hosts:
+        raise Exception(f'TSM repository hosts {missing_hosts} do not match any instance of the stack.')
+
+    return [get_host_instance(host) for host in repository_hosts]
+
+
+def build_role_index(clients, instances_sorted, use_tsm_topology=False, allow_name_sort=False):
+    # Returns {'primary', 'repository', 'role_by_id', 'repository_ids', 'by_id', 'source'} for the stack, from the
+    # service-role and tableau-repository tags of the inventory, optionally with the repository nodes confirmed by
+    # TSM.  The phases look instances up here instead of scanning the lists.  When the tags do not answer, the old
+    # name-sort guess (first instance is primary, all but the last two hold the repository) is only used with
+    # allow_name_sort, since a wrong guess stops and resizes the wrong nodes; otherwise it raises.
+    source = 'tags'
+    primary_instances = [record for record in instances_sorted
+                         if (record.service_role or '').lower() == PRIMARY_ROLE]
+    if len(primary_instances) == 1:
+        primary_instance = primary_instances[0]
+    elif allow_name_sort:
+        logger.warning(f'Found {len(primary_instances)} instances tagged {ROLE_TAG_KEY}={PRIMARY_ROLE}, '
+                       f'using the first instance by name as primary.')
+        primary_instance = instances_sorted[0]
+        source = 'name-sort'
+    else:
+        raise Exception(f'Found {len(primary_instances)} instances tagged {ROLE_TAG_KEY}={PRIMARY_ROLE} instead of '
+                        f'one, fix the tags or use --allow-name-sort.')
+
+    repository_instances = [record for record in instances_sorted
+                            if (record.repository or '').lower() in REPOSITORY_TAG_VALUES]
+    if use_tsm_topology and primary_instance.state == 'running':
+        try:
+            tsm_repository_instances = get_tsm_repository_instances(clients, primary_instance, instances_sorted)
+            if tsm_repository_instances:
+                repository_instances = sorted(tsm_repository_instances, key=lambda instance: instance[1])
+                source = f'{source}+tsm'
+            else:
+                logger.warning('TSM reported no repository nodes, using the tags.')
+        except Exception as e:
+            logger.warning(f'Unable to read the repository nodes from TSM, using the tags:\n{e}')
+    if not repository_instances:
+        if not allow_name_sort:
+            raise Exception(f'No instance tagged {REPOSITORY_TAG_KEY}, fix the tags or use --allow-name-sort.')
+        logger.warning(f'No instance tagged {REPOSITORY_TAG_KEY}, assuming all but the last two instances by name '
+                       f'hold the repository.')
+        repository_instances = instances_sorted[:len(instances_sorted)-2]
+        source = 'name-sort'
+
+    return {
+        'primary': primary_instance,
+        'repository': repository_instances,
+        'role_by_id': {record.instance_id: PRIMARY_ROLE if record.instance_id == primary_instance.instance_id
+                       else 'worker' for record in instances_sorted},
+        'repository_ids': {record.instance_id for record in repository_instances},
+        'by_id': {record.instance_id: record for record in instances_sorted},
+        'source': source
+    }
+
+
+def is_primary_instance(stack, this_instance):
+    return stack['roles']['role_by_id'][this_instance[0]] == PRIMARY_ROLE
+
+
+def discover_stack(clients, pipeline_id, use_tsm_topology=False, allow_name_sort=False):
+    # Get all instances with the current pipeline number.
+    stack_tag_name = "stack-pipeline-number"
+    with timed_phase('inventory'):
+        instances = get_stack_inventory(clients["ec2_client"], stack_tag_name, pipeline_id)
+    logger.info(f'instances: {[[record.instance_id, record.name] for record in instances]}')
+    if not instances:
+        raise Exception(f'No instances found with {stack_tag_name} {pipeline_id}.')
+    instances_sorted = sorted(instances, key=lambda instance: instance[1])
+
+    # Build the role index once; every phase looks its instances up here.
+    with timed_phase('role_discovery'):
+        roles = build_role_index(clients, instances_sorted, use_tsm_topology, allow_name_sort)
+    logger.info(f'Roles found from {roles["source"]}.')
+    logger.info(f'Primary instance: {roles["primary"]}.')
+    logger.info(f'Repository instances: {roles["repository"]}.')
+
+    return {
+        'instances_sorted': instances_sorted,
+        'primary_instance': roles['primary'],
+        'instances_sorted_reduced': roles['repository'],
+        'roles': roles
+    }
+
+
+def get_changed_instances(stack, instance_type, checkpoint):
+    # Only the repository instances not already at the requested type need the stop/modify/start cycle.  When
+    # resuming, the types may already have changed, so reuse the plan of the run that started the cutover.
+    if checkpoint['completed_phases'] and 'changed_instance_ids' in checkpoint:
+        by_id = stack['roles']['by_id']
+        changed_instances = [by_id[instance_id] for instance_id in checkpoint['changed_instance_ids']
+                             if instance_id in by_id]
+    else:
+        changed_instances = plan_type_changes(stack['instances_sorted_reduced'], instance_type)
+        checkpoint['changed_instance_ids'] = [this_instance[0] for this_instance in changed_instances]
+    logger.info(f'Instances to change: {changed_instances}')
+
+    return changed_instances
+
 
-    # Activate licenses and restart Tableau Server.
-    license_and_restart_tableau(clients, s3_bucket, primary_instance_id, primary_instance_name)
+# Service Quotas code of "Running On-Demand Standard (A, C, D, H, I, M, R, T, Z) instances", in vCPUs.
+STANDARD_VCPU_QUOTA_CODE = 'L-1216C47A'
+STANDARD_INSTANCE_FAMILIES = 'acdhimrtz'
+# Families starting with one of the standard letters that have a quota of their own.
+NON_STANDARD_INSTANCE_FAMILY_PREFIXES = ('dl', 'hpc', 'inf', 'trn')
+
+# describe_instance_types accepts at most 100 instance types.
+DESCRIBE_INSTANCE_TYPES_CHUNK = 100
+
+# Capacity reservations only match instances of the same platform, and all Tableau nodes run Windows.
+CAPACITY_RESERVATION_PLATFORM = 'Windows'
+# A reservation expires after this many hours in case the run dies before releasing it.
+CAPACITY_RESERVATION_HOURS = 6
+
+# Error codes of a lookup the credentials are not allowed to make.
+ACCESS_DENIED_ERROR_CODES = ['AccessDenied', 'AccessDeniedException', 'UnauthorizedOperation']
+
+preflight_cache_lock = threading.Lock()
+
+
+def is_standard_instance_type(instance_type):
+    family = instance_type.split('.')[0]
+    return family[0] in STANDARD_INSTANCE_FAMILIES and not family.startswith(NON_STANDARD_INSTANCE_FAMILY_PREFIXES)
+
+
+def get_offered_availability_zones(ec2_client, instance_type):
+    availability_zones = []
+    paginator = ec2_client.get_paginator('describe_instance_type_offerings')
+    for page in paginator.paginate(LocationType='availability-zone',
+                                   Filters=[{'Name': 'instance-type', 'Values': [instance_type]}]):
+        availability_zones += [offering['Location'] for offering in page['InstanceTypeOfferings']]
+
+    return sorted(availability_zones)
+
+
+def get_instance_types_vcpus(ec2_client, instance_types):
+    # Returns {instance_type: default vCPUs}.
+    instance_types_vcpus = {}
+    paginator = ec2_client.get_paginator('describe_instance_types')
+    for i in range(0, len(instance_types), DESCRIBE_INSTANCE_TYPES_CHUNK):
+        for page in paginator.paginate(InstanceTypes=instance_types[i:i + DESCRIBE_INSTANCE_TYPES_CHUNK]):
+            for instance_type_info in page['InstanceTypes']:
+                instance_types_vcpus[instance_type_info['InstanceType']] = \
+                    instance_type_info['VCpuInfo']['DefaultVCpus']
+
+    return instance_types_vcpus
+
+
+def get_standard_vcpu_quota(service_quotas_client):
+    response = service_quotas_client.get_service_quota(ServiceCode='ec2', QuotaCode=STANDARD_VCPU_QUOTA_CODE)
+    return response['Quota']['Value']
+
+
+@lru_cache(maxsize=None)
+def get_account_id(sts_client):
+    # Fetched once per client, i.e. once per profile.
+    return sts_client.get_caller_identity()['Account']
+
+
+def load_preflight_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return {}
+
+    try:
+        with open(cache_file) as cache_input:
+            return json.load(cache_input)
+    except (OSError, ValueError) as e:
+        logger.warning(f'Unable to read preflight cache {cache_file}, looking everything up again:\n{e}')
+        return {}
+
+
+def save_preflight_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    temporary_path = f'{cache_file}.tmp'
+    with open(temporary_path, 'w') as cache_output:
+        json.dump(cache, cache_output, indent=2, sort_keys=True)
+    os.replace(temporary_path, cache_file)
+
+
+def preflight_instance_type(clients, changed_instances, instance_type, cache_file, cache_ttl):
+    # Runs before anything is stopped, so a type that cannot be started fails the run while Tableau still serves:
+    # the type must be offered in the availability zones of the changed instances, and the standard on-demand vCPU
+    # quota must leave room for the additional vCPUs.  The offerings, vCPU counts and quota are cached per account
+    # and region for cache_ttl seconds, the running vCPUs are always counted live.  A check the credentials are not
+    # allowed to make is skipped with a warning.  Raises if the type does not fit.
+    ec2_client = clients["ec2_client"]
+    # Availability zone names map to different zones in each account, and the quota is per account.
+    cache_prefix = f'{get_account_id(clients["sts_client"])}/{ec2_client.meta.region_name}'
+    # The lock only covers the cache file, so concurrent pipelines do not wait on each other's lookups.  The
+    # entries looked up here are merged into the file as it is when saving.
+    with preflight_cache_lock:
+        cache = load_preflight_cache(cache_file)
+    cache_updates = {}
+    now = time.time()
+
+    def is_fresh(entry):
+        return entry is not None and now - entry['time'] < cache_ttl
+
+    def get_cached(key, lookup):
+        if not is_fresh(cache.get(key)):
+            cache[key] = cache_updates[key] = {'time': now, 'value': lookup()}
+        return cache[key]['value']
+
+    def get_cached_vcpus(instance_types):
+        keys = {this_type: f'{cache_prefix}/{this_type}/vcpus' for this_type in set(instance_types)}
+        missing_types = sorted(this_type for this_type, key in keys.items() if not is_fresh(cache.get(key)))
+        for this_type, vcpus in get_instance_types_vcpus(ec2_client, missing_types).items():
+            cache[keys[this_type]] = cache_updates[keys[this_type]] = {'time': now, 'value': vcpus}
+        return {this_type: cache[key]['value'] for this_type, key in keys.items()}
+
+    def is_access_denied(error):
+        return error.response.get('Error', {}).get('Code') in ACCESS_DENIED_ERROR_CODES
+
+    try:
+        try:
+            offered_availability_zones = get_cached(f'{cache_prefix}/{instance_type}/availability_zones',
+                                                    partial(get_offered_availability_zones, ec2_client,
+                                                            instance_type))
+            missing_availability_zones = sorted({record.availability_zone for record in changed_instances
+                                                 if record.availability_zone not in offered_availability_zones})
+            if missing_availability_zones:
+                raise Exception(f'{instance_type} is not offered in {missing_availability_zones}, '
+                                f'not starting the cutover.')
+            logger.info(f'{instance_type} is offered in {offered_availability_zones}.')
+        except ClientError as e:
+            if not is_access_denied(e):
+                raise
+            logger.warning(f'Not allowed to check the {instance_type} offerings, skipping it:\n{e}')
+
+        if not is_standard_instance_type(instance_type):
+            logger.info(f'{instance_type} is not a standard instance type, skipping the vCPU quota check.')
+            return
+        try:
+            vcpus = get_cached_vcpus([instance_type] + [record.instance_type for record in changed_instances])
+            # Changed instances that are running count in the quota with their current type already.
+            additional_vcpus = sum(vcpus[instance_type] - (vcpus[record.instance_type]
+                                                           if record.state in ['pending', 'running'] else 0)
+                                   for record in changed_instances)
+            if additional_vcpus <= 0:
+                logger.info('The cutover needs no additional vCPUs, skipping the vCPU quota check.')
+                return
+            vcpu_quota = get_cached(f'{cache_prefix}/{STANDARD_VCPU_QUOTA_CODE}/quota',
+                                    partial(get_standard_vcpu_quota, clients["service_quotas_client"]))
+            running_types = [instance['InstanceType'] for instance in describe_instances_paginated(
+                ec2_client, Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running']}])
+                             if is_standard_instance_type(instance['InstanceType'])]
+            vcpus.update(get_cached_vcpus(running_types))
+        except ClientError as e:
+            if not is_access_denied(e):
+                raise
+            logger.warning(f'Not allowed to check the vCPU quota, skipping it:\n{e}')
+            return
+
+        running_vcpus = sum(vcpus[this_type] for this_type in running_types)
+        logger.info(f'Standard vCPUs: {running_vcpus} running, {additional_vcpus} more needed, '
+                    f'quota {vcpu_quota:.0f}.')
+        if running_vcpus + additional_vcpus > vcpu_quota:
+            raise Exception(f'{instance_type} needs {additional_vcpus} more vCPUs but only '
+                            f'{vcpu_quota - running_vcpus:.0f} are left in quota {STANDARD_VCPU_QUOTA_CODE}, '
+                            f'not starting the cutover.')
+    finally:
+        if cache_updates:
+            with preflight_cache_lock:
+                save_preflight_cache(cache_file, dict(load_preflight_cache(cache_file), **cache_updates))
+
+
+def cancel_capacity_reservations(ec2_client, capacity_reservation_ids):
+    for capacity_reservation_id in capacity_reservation_ids:
+        try:
+            ec2_client.cancel_capacity_reservation(CapacityReservationId=capacity_reservation_id)
+            logger.info(f'Released capacity reservation {capacity_reservation_id}.')
+        except ClientError as e:
+            logger.error(f'ClientError while trying to cancel capacity reservation {capacity_reservation_id}, '
+                         f'cancel it by hand:\n{e}')
+
+
+def reserve_capacity(ec2_client, changed_instances, instance_type, hours=CAPACITY_RESERVATION_HOURS):
+    # One on-demand capacity reservation per availability zone for the changed instances there, made before
+    # anything is stopped and ending after hours.  The reservations are open, so the instances use them when they
+    # start with the new type.  Returns the reservation ids, raising (and releasing what was reserved) if EC2 has
+    # not got the capacity.
+    instance_counts = {}
+    for record in changed_instances:
+        instance_counts[record.availability_zone] = instance_counts.get(record.availability_zone, 0) + 1
+
+    capacity_reservation_ids = []
+    for availability_zone, instance_count in sorted(instance_counts.items()):
+        try:
+            response = ec2_client.create_capacity_reservation(
+                InstanceType=instance_type,
+                InstancePlatform=CAPACITY_RESERVATION_PLATFORM,
+                AvailabilityZone=availability_zone,
+                InstanceCount=instance_count,
+                InstanceMatchCriteria='open',
+                EndDateType='limited',
+                EndDate=int(time.time()) + hours * 3600)
+        except ClientError as e:
+            cancel_capacity_reservations(ec2_client, capacity_reservation_ids)
+            raise Exception(f'Unable to reserve {instance_count} {instance_type} in {availability_zone}, '
+                            f'not starting the cutover:\n{e}')
+        capacity_reservation_ids.append(response['CapacityReservation']['CapacityReservationId'])
+        logger.info(f'Reserved {instance_count} {instance_type} in {availability_zone}: '
+                    f'{capacity_reservation_ids[-1]}.')
+
+    return capacity_reservation_ids
+
+
+def build_cutover_tasks(clients, stack, changed_instances, instance_type, s3_bucket, refresh_health=False):
+    # The cutover as a DAG of (task_name, task_function, dependencies).  The primary is stopped before the workers
+    # and started after them; each of these ordering groups is stopped and started with one multi-ID call, followed
+    # by one wait task per instance, so every instance goes on with its type change, D: drive and reboot as soon as
+    # it is ready, and Tableau is licensed and restarted once all are done.  Every task is safe to rerun, so a
+    # failed run resumes at the tasks that did not complete.  With refresh_health the health check before Tableau is
+    # stopped re-describes the stack instead of using the inventory of the discovery.
+    instances_sorted = stack['instances_sorted']
+    primary_instance_id, primary_instance_name = stack['primary_instance'][0], stack['primary_instance'][1]
+    changed_primary = [this_instance for this_instance in changed_instances
+                       if is_primary_instance(stack, this_instance)]
+    changed_workers = [this_instance for this_instance in changed_instances
+                       if not is_primary_instance(stack, this_instance)]
+
+    tasks = [('stop_and_delicense_tableau', partial(check_health_and_stop_tableau, clients, instances_sorted,
+                                                    primary_instance_id, primary_instance_name, s3_bucket,
+                                                    refresh_health), [])]
+    stop_dependencies = ['stop_and_delicense_tableau']
+    for group_name, group_instances in [('primary', changed_primary), ('workers', changed_workers)]:
+        if not group_instances:
+            continue
+        tasks.append((f'stop_instances:{group_name}',
+                      partial(call_cutover_instances, clients, 'stop_instances', group_instances), stop_dependencies))
+        for this_instance in group_instances:
+            this_instance_name = this_instance[1]
+            tasks += [
+                (f'stop_instance:{this_instance_name}', partial(stop_cutover_instance, clients, this_instance),
+                 [f'stop_instances:{group_name}']),
+                (f'change_instance_type:{this_instance_name}',
+                 partial(change_and_verify_instances_type, clients, instance_type, [this_instance]),
+                 [f'stop_instance:{this_instance_name}'])
+            ]
+        stop_dependencies = [f'stop_instance:{this_instance[1]}' for this_instance in group_instances]
+
+    start_dependencies = []
+    for group_name, group_instances in [('workers', changed_workers), ('primary', changed_primary)]:
+        if not group_instances:
+            continue
+        tasks.append((f'start_instances:{group_name}',
+                      partial(call_cutover_instances, clients, 'start_instances', group_instances),
+                      start_dependencies + [f'change_instance_type:{this_instance[1]}'
+                                            for this_instance in group_instances]))
+        for this_instance in group_instances:
+            this_instance_name = this_instance[1]
+            tasks += [
+                (f'start_instance:{this_instance_name}', partial(start_cutover_instance, clients, this_instance),
+                 [f'start_instances:{group_name}']),
+                (f'bring_d_drive_online:{this_instance_name}', partial(bring_d_drive_online, clients, [this_instance]),
+                 [f'start_instance:{this_instance_name}']),
+                (f'reboot_server:{this_instance_name}', partial(reboot_servers, clients, [this_instance]),
+                 [f'bring_d_drive_online:{this_instance_name}'])
+            ]
+        start_dependencies = [f'start_instance:{this_instance[1]}' for this_instance in group_instances]
+    tasks.append(('license_and_restart_tableau', partial(license_and_restart_tableau, clients, s3_bucket,
+                                                         primary_instance_id, primary_instance_name),
+                  [f'reboot_server:{this_instance[1]}' for this_instance in changed_instances]))
+
+    return tasks
+
+
+# Prints the cluster status, e.g. "Status: RUNNING" or "Status: DEGRADED" while a node is down.
+TSM_STATUS_COMMAND = 'tsm status'
+
+
+def parse_tsm_status(standard_output_content):
+    for line in standard_output_content.splitlines():
+        if line.strip().lower().startswith('status:'):
+            return line.split(':', 1)[1].strip().upper()
+
+    return 'UNKNOWN'
+
+
+def wait_for_tableau_healthy(clients, primary_instance, timeout=1800, initial_poll_delay=10, max_poll_delay=60,
+                             backoff_factor=2):
+    # Polls `tsm status` on the primary until the whole cluster is RUNNING again.  A node that just rebooted
+    # leaves the cluster DEGRADED until TSM has started its processes.
+    deadline = time.monotonic() + timeout
+    poll_delay = initial_poll_delay
+    while True:
+        try:
+            output = run_ssm_command(clients, [primary_instance], 'AWS-RunPowerShellScript', {
+                'executionTimeout': ['300'],
+                'commands': [TSM_STATUS_COMMAND]
+            }, timeout=300)
+            tsm_status = parse_tsm_status(output[primary_instance[0]])
+        except Exception as e:
+            logger.warning(f'Unable to read the TSM status from {primary_instance[1]}:\n{e}')
+            tsm_status = 'UNKNOWN'
+        if tsm_status == 'RUNNING':
+            logger.info(f'Tableau Server on {primary_instance[1]} is RUNNING.')
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f'Tableau Server on {primary_instance[1]} is still {tsm_status} after {timeout}s.')
+        logger.info(f'Tableau Server on {primary_instance[1]} is {tsm_status}, checking again in {poll_delay}s.')
+        time.sleep(min(poll_delay, remaining))
+        poll_delay = min(poll_delay * backoff_factor, max_poll_delay)
+
+
+def resize_worker_batch(clients, instance_type, batch, primary_instance, capacity_reservation=False):
+    # One rolling step: the batch goes through stop, type change, start, D: drive and reboot while the rest of the
+    # cluster keeps serving, then the cluster must be healthy again before the next batch.  Unlike the full
+    # cutover, any failure stops the run, so no more capacity is taken out than one batch.  With
+    # capacity_reservation the capacity of the batch is reserved before it is stopped until it is started again.
+    batch_names = [this_instance[1] for this_instance in batch]
+    logger.info(f'Resizing workers {batch_names} while the rest of the cluster keeps serving.')
+    capacity_reservation_ids = []
+    if capacity_reservation:
+        capacity_reservation_ids = reserve_capacity(clients["ec2_client"], batch, instance_type)
+    try:
+        failed_instances = stop_instances_batch(clients["ec2_client"], batch)
+        if failed_instances:
+            raise Exception(f'Instances failed to stop: {failed_instances}.')
+
+        change_and_verify_instances_type(clients, instance_type, batch)
+
+        failed_instances = start_instances_batch(clients["ec2_client"], batch)
+        if failed_instances:
+            raise Exception(f'Instances failed to start: {failed_instances}.')
+    finally:
+        cancel_capacity_reservations(clients["ec2_client"], capacity_reservation_ids)
+
+    bring_d_drive_online(clients, batch)
+    reboot_servers(clients, batch)
+    wait_for_tableau_healthy(clients, primary_instance)
+    logger.info(f'Workers {batch_names} are resized and the cluster is RUNNING.')
+
+
+def get_rolling_batches(stack, changed_instances, batch_size):
+    # The changed workers in batches of batch_size, in name order.
+    if batch_size < 1:
+        raise Exception(f'--batch-size must be at least 1, got {batch_size}.')
+    changed_workers = [this_instance for this_instance in changed_instances
+                       if not is_primary_instance(stack, this_instance)]
+    repository_ids = stack['roles']['repository_ids']
+    batches = [changed_workers[i:i + batch_size] for i in range(0, len(changed_workers), batch_size)]
+    for batch in batches:
+        # Tableau only fails over to the passive repository, stopping every repository node at once is an outage.
+        if repository_ids <= {this_instance[0] for this_instance in batch}:
+            raise Exception(f'Batch {[this_instance[1] for this_instance in batch]} holds every repository node, '
+                            f'use a smaller --batch-size.')
+
+    return batches
+
+
+def build_rolling_tasks(clients, stack, changed_instances, instance_type, s3_bucket, batch_size,
+                        capacity_reservation=False):
+    # The rolling cutover: the changed workers in batches of batch_size, each batch only starting once the
+    # cluster is healthy, then the primary through the regular cutover tasks, which is the only outage.  With
+    # capacity_reservation every batch reserves its own capacity; the primary's is reserved by resize_pipeline.
+    primary_instance = stack['primary_instance']
+    batches = get_rolling_batches(stack, changed_instances, batch_size)
+    tasks = [('rolling_health_check', partial(wait_for_tableau_healthy, clients, primary_instance, timeout=300), [])]
+    for number, batch in enumerate(batches, 1):
+        tasks.append((f'rolling_batch_{number}', partial(resize_worker_batch, clients, instance_type, batch,
+                                                         primary_instance, capacity_reservation), [tasks[-1][0]]))
+    changed_primary = [this_instance for this_instance in changed_instances
+                       if is_primary_instance(stack, this_instance)]
+    if changed_primary:
+        last_rolling_task = tasks[-1][0]
+        tasks += [(task_name, task_function, dependencies or [last_rolling_task])
+                  for task_name, task_function, dependencies in build_cutover_tasks(
+                      clients, stack, changed_primary, instance_type, s3_bucket, refresh_health=True)]
+
+    return tasks
+
+
+def get_cutover_mode(arguments):
+    return 'rolling' if arguments.rolling else 'full'
+
+
+def build_pipeline_tasks(clients, stack, changed_instances, instance_type, arguments):
+    if arguments.rolling:
+        return build_rolling_tasks(clients, stack, changed_instances, instance_type, arguments.bucket,
+                                   arguments.batch_size, arguments.capacity_reservation)
+
+    return build_cutover_tasks(clients, stack, changed_instances, instance_type, arguments.bucket)
+
+
+def resize_pipeline(clients, pipeline_id, instance_type, arguments):
+    stack = discover_stack(clients, pipeline_id, arguments.tsm_topology, arguments.allow_name_sort)
+    checkpoint_path = get_checkpoint_path(arguments.checkpoint_dir, pipeline_id)
+    checkpoint = load_checkpoint(checkpoint_path, pipeline_id, instance_type, stack['instances_sorted'],
+                                 resume=not arguments.no_resume, mode=get_cutover_mode(arguments))
+    changed_instances = get_changed_instances(stack, instance_type, checkpoint)
+    set_run_metric('nodes', len(stack['instances_sorted']))
+    set_run_metric('changed_nodes', len(changed_instances))
+
+    if not changed_instances:
+        logger.info(f'All instances of pipeline {pipeline_id} already are {instance_type}, skipping the cutover.')
+        clear_checkpoint(checkpoint_path)
+        return
+
+    # Building the tasks validates the plan, e.g. the rolling batches, so it must fail before capacity is reserved.
+    tasks = build_pipeline_tasks(clients, stack, changed_instances, instance_type, arguments)
+    with timed_phase('preflight'):
+        preflight_instance_type(clients, changed_instances, instance_type, arguments.preflight_cache_file,
+                                arguments.preflight_cache_ttl)
+        capacity_reservation_ids = []
+        if arguments.capacity_reservation and arguments.rolling:
+            # The batches reserve their own capacity.  The primary goes last, possibly many hours from now, so
+            # its reservation must outlast the estimated rolling cutover.
+            changed_primary = [this_instance for this_instance in changed_instances
+                               if is_primary_instance(stack, this_instance)]
+            if changed_primary:
+                task_estimates = estimate_task_times(tasks, checkpoint, load_run_history(arguments.history_file),
+                                                     len(changed_instances))
+                estimated_duration = max(start_time + estimate
+                                         for start_time, estimate, based_on_runs in task_estimates.values())
+                capacity_reservation_ids = reserve_capacity(
+                    clients["ec2_client"], changed_primary, instance_type,
+                    CAPACITY_RESERVATION_HOURS + math.ceil(estimated_duration / 3600))
+        elif arguments.capacity_reservation:
+            capacity_reservation_ids = reserve_capacity(clients["ec2_client"], changed_instances, instance_type)
+
+    try:
+        run_tasks(tasks, checkpoint, checkpoint_path)
+    finally:
+        cancel_capacity_reservations(clients["ec2_client"], capacity_reservation_ids)
+    clear_checkpoint(checkpoint_path)
+
+    logger.info(f'Completed the resize of pipeline {pipeline_id}.')
+
+
+# Rough task durations in seconds used by --plan until the history has timings of real runs, by kind (see
+# get_phase_kind).
+DEFAULT_PHASE_ESTIMATES = {
+    'stop_and_delicense_tableau': 180,
+    'stop_instances': 1,
+    'stop_instance': 120,
+    'change_instance_type': 5,
+    'start_instances': 1,
+    'start_instance': 300,
+    'bring_d_drive_online': 30,
+    'reboot_server': 180,
+    'license_and_restart_tableau': 360,
+    'rolling_health_check': 15,
+    'rolling_batch': 900
+}
+
+# Number of runs kept in the history file.
+HISTORY_LIMIT = 100
+
+
+def load_run_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+
+    try:
+        with open(history_file) as history_input:
+            return json.load(history_input)
+    except (OSError, ValueError) as e:
+        logger.warning(f'Unable to read run history {history_file}:\n{e}')
+        return []
+
+
+def record_run_history(history_file, run_metrics):
+    # Keep the phase timings of completed cutovers for the --plan estimates.  No-op runs have nothing to learn from.
+    if not run_metrics.get('changed_nodes'):
+        return
+
+    with metrics_lock:
+        run_history = load_run_history(history_file)
+        run_history.append({
+            'pipeline_id': run_metrics['pipeline_id'],
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'status': run_metrics['status'],
+            'nodes': run_metrics.get('nodes'),
+            'changed_nodes': run_metrics['changed_nodes'],
+            'duration': run_metrics['duration'],
+            'phases': run_metrics['phases']
+        })
+        os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+        temporary_path = f'{history_file}.tmp'
+        with open(temporary_path, 'w') as history_output:
+            json.dump(run_history[-HISTORY_LIMIT:], history_output, indent=2)
+        os.replace(temporary_path, history_file)
+
+
+def estimate_phase_duration(run_history, phase_name, changed_nodes):
+    # Median of the successful runs that changed the same number of nodes, else of all successful runs, else the
+    # default estimate, over every phase of the same kind (see get_phase_kind).
+    # Returns (seconds, number of runs the estimate is based on).
+    phase_kind = get_phase_kind(phase_name)
+
+    def get_durations(run):
+        return [duration for name, duration in run['phases'].items() if get_phase_kind(name) == phase_kind]
+
+    successful_runs = [run for run in run_history if run['status'] == 'succeeded' and get_durations(run)]
+    similar_runs = [run for run in successful_runs if run['changed_nodes'] == changed_nodes]
+    for runs in [similar_runs, successful_runs]:
+        if runs:
+            return statistics.median(duration for run in runs for duration in get_durations(run)), len(runs)
+
+    return DEFAULT_PHASE_ESTIMATES[phase_kind], 0
+
+
+def estimate_task_times(tasks, checkpoint, run_history, changed_nodes):
+    # Returns {task_name: (start, duration, number of runs the estimate is based on)}, in seconds from the start of
+    # the cutover along the task DAG.  Tasks completed by a previous run take no time.
+    task_estimates = {}
+    for task_name, _, dependencies in tasks:
+        start_time = max((sum(task_estimates[name][:2]) for name in dependencies), default=0)
+        if task_name in checkpoint['completed_phases']:
+            task_estimates[task_name] = (start_time, 0, 0)
+        else:
+            task_estimates[task_name] = (start_time, *estimate_phase_duration(run_history, task_name, changed_nodes))
+
+    return task_estimates
+
+
+def plan_pipeline(clients, pipeline_id, instance_type, arguments):
+    # Dry run: only describe calls are made.  Logs the tasks of the cutover with their targets, SSM documents and
+    # estimated start, and the downtime as the critical path through the task DAG, estimated from previous runs.
+    # Returns the estimated downtime in seconds.
+    # The TSM topology query is an SSM command, which a plan must not send, so plans use the tags only.
+    if arguments.tsm_topology:
+        logger.info('Planning from the tags, the TSM topology is only queried by a real run.')
+    stack = discover_stack(clients, pipeline_id, allow_name_sort=arguments.allow_name_sort)
+    checkpoint = load_checkpoint(get_checkpoint_path(arguments.checkpoint_dir, pipeline_id), pipeline_id,
+                                 instance_type, stack['instances_sorted'], resume=not arguments.no_resume,
+                                 mode=get_cutover_mode(arguments))
+    changed_instances = get_changed_instances(stack, instance_type, checkpoint)
+    if not changed_instances:
+        logger.info(f'Plan for pipeline {pipeline_id}: all instances already are {instance_type}, nothing to do.')
+        return 0
+
+    # The preflight only reads, so the plan runs it too, but reports a failure instead of stopping there.
+    try:
+        preflight_instance_type(clients, changed_instances, instance_type, arguments.preflight_cache_file,
+                                arguments.preflight_cache_ttl)
+    except Exception as e:
+        logger.warning(f'Preflight of pipeline {pipeline_id} failed, the cutover would not start: {e}')
+    if arguments.capacity_reservation:
+        logger.info(f'A real run reserves {instance_type} capacity for {len(changed_instances)} instances first.')
+
+    primary_name = stack['primary_instance'][1]
+    task_actions = {
+        'stop_and_delicense_tableau': f'{primary_name}: TableauServiceStop, TableauDeactivateLicenses '
+                                      f'(skipped unless all instances are healthy)',
+        'license_and_restart_tableau': f'{primary_name}: TableauActivateLicenses, TableauServiceRestart',
+        'rolling_health_check': f'{primary_name}: AWS-RunPowerShellScript {TSM_STATUS_COMMAND} until RUNNING'
+    }
+    for group_name, is_primary in [('primary', True), ('workers', False)]:
+        group_names = [record.name for record in changed_instances
+                       if is_primary_instance(stack, record) == is_primary]
+        task_actions.update({
+            f'stop_instances:{group_name}': f'stop_instances {group_names}',
+            f'start_instances:{group_name}': f'start_instances {group_names}'
+        })
+    for record in changed_instances:
+        task_actions.update({
+            f'stop_instance:{record.name}': f'{record.name}: wait until stopped',
+            f'change_instance_type:{record.name}': f'{record.name}: {record.instance_type} -> {instance_type}',
+            f'start_instance:{record.name}': f'{record.name}: wait until status ok',
+            f'bring_d_drive_online:{record.name}': f'{record.name}: AWS-RunPowerShellScript Set-Disk',
+            f'reboot_server:{record.name}': f'{record.name}: AWS-RunPowerShellScript restart_computer.ps1'
+        })
+    if arguments.rolling:
+        for number, batch in enumerate(get_rolling_batches(stack, changed_instances, arguments.batch_size), 1):
+            task_actions[f'rolling_batch_{number}'] = (f'{[this_instance[1] for this_instance in batch]}: stop, '
+                                                       f'{instance_type}, start, D: drive, reboot, then '
+                                                       f'{TSM_STATUS_COMMAND} until RUNNING')
+
+    logger.info(f'Plan for pipeline {pipeline_id} ({len(stack["instances_sorted"])} instances, '
+                f'{len(changed_instances)} to change to {instance_type}):')
+    tasks = build_pipeline_tasks(clients, stack, changed_instances, instance_type, arguments)
+    task_estimates = estimate_task_times(tasks, checkpoint, load_run_history(arguments.history_file),
+                                         len(changed_instances))
+    finish_times = {task_name: start_time + estimate
+                    for task_name, (start_time, estimate, based_on_runs) in task_estimates.items()}
+    for step, (task_name, _, dependencies) in enumerate(tasks, 1):
+        start_time, estimate, based_on_runs = task_estimates[task_name]
+        if task_name in checkpoint['completed_phases']:
+            logger.info(f'  {step}. {task_name}: completed by a previous run, skipped.')
+            continue
+        logger.info(f'  {step}. {task_name} (at +{start_time:.0f}s, ~{estimate:.0f}s, '
+                    f'{f"median of {based_on_runs} runs" if based_on_runs else "default estimate"}): '
+                    f'{task_actions[task_name]}')
+
+    # The rest of the cluster keeps serving during the rolling tasks, the outage is what comes after them.
+    estimated_reduced_capacity = max((finish_time for task_name, finish_time in finish_times.items()
+                                      if task_name.startswith('rolling_')), default=0)
+    estimated_downtime = max(finish_times.values()) - estimated_reduced_capacity
+    if arguments.rolling:
+        logger.info(f'Estimated reduced capacity for pipeline {pipeline_id}: '
+                    f'{estimated_reduced_capacity / 60:.1f} minutes.')
+    logger.info(f'Estimated Tableau downtime for pipeline {pipeline_id}: {estimated_downtime / 60:.1f} minutes.')
+
+    return estimated_downtime
+
+
+def run_pipeline(clients, pipeline_id, instance_type, arguments):
+    # Runs one pipeline and returns its summary instead of raising, so one failure does not stop the others.
+    threading.current_thread().name = f'pipeline-{pipeline_id}'
+    summary = {'pipeline_id': pipeline_id, 'instance_type': instance_type, 'status': 'succeeded', 'error': None}
+    if arguments.plan:
+        try:
+            summary['estimated_downtime'] = plan_pipeline(clients, pipeline_id, instance_type, arguments)
+            summary['status'] = 'planned'
+        except Exception as e:
+            logger.error(f'Plan of pipeline {pipeline_id} failed: {e}', exc_info=True)
+            summary['status'] = 'failed'
+            summary['error'] = str(e)
+        summary['duration'] = 0
+        return summary
+
+    run_metrics = new_run_metrics(pipeline_id)
+    start_time = time.monotonic()
+    try:
+        resize_pipeline(clients, pipeline_id, instance_type, arguments)
+    except Exception as e:
+        logger.error(f'Resize of pipeline {pipeline_id} failed: {e}', exc_info=True)
+        summary['status'] = 'failed'
+        summary['error'] = str(e)
+    summary['duration'] = round(time.monotonic() - start_time, 1)
+
+    run_metrics['duration'] = summary['duration']
+    run_metrics['status'] = summary['status']
+    summary['metrics'] = run_metrics
+    emit_run_metrics(run_metrics, arguments.metrics_file)
+    record_run_history(arguments.history_file, run_metrics)
+
+    return summary
+
+
+def run_pipelines(clients, pipeline_specs, arguments, max_concurrency):
+    # All pipelines share the same clients (boto3 clients are thread safe) and the same logging handler.
+    if len(pipeline_specs) == 1:
+        pipeline_id, instance_type = pipeline_specs[0]
+        return [run_pipeline(clients, pipeline_id, instance_type, arguments)]
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [submit_with_context(executor, run_pipeline, clients, pipeline_id, instance_type, arguments)
+                   for pipeline_id, instance_type in pipeline_specs]
+
+    return [future.result() for future in futures]
+
+
+def log_pipelines_summary(summaries):
+    logger.info('Resize summary:')
+    for summary in summaries:
+        if 'estimated_downtime' in summary:
+            details = f'estimated downtime {summary["estimated_downtime"] / 60:.1f} minutes'
+        else:
+            details = f'{summary["duration"]}s'
+        logger.info(f'  {summary["pipeline_id"]}: {summary["status"]} ({summary["instance_type"]}, '
+                    f'{details}){"  " + summary["error"] if summary["error"] else ""}')
+
+
+def main():
+    arguments = set_arguments()
+    pipeline_specs = get_pipeline_specs(arguments)
+    max_concurrency = max(1, min(arguments.max_concurrency, len(pipeline_specs)))
+    session = configure_session(arguments)
+    # Planning must not change anything, so it does not create a CloudWatch log stream either.
+    init_logging(arguments.logging_level, session, cloudwatch=not arguments.plan)
+    clients = ClientCache(session, get_client_config(max_concurrency))
+
+    summaries = run_pipelines(clients, pipeline_specs, arguments, max_concurrency)
+    log_pipelines_summary(summaries)
+
+    failed_pipelines = [summary['pipeline_id'] for summary in summaries if summary['status'] == 'failed']
+    if failed_pipelines:
+        raise Exception(f'Resize failed for pipelines {failed_pipelines}.')
 
     logger.info(f'Completed the Resize Instances script.')
 
+
 if __name__ == "__main__":
     try:
         main()
     except Exception as e:
-        logging.critical(f"Unhandled exception: {e}", exc_info=True)
-        logging.critical("Exiting")
+        logger.critical(f"Unhandled exception: {e}", exc_info=True)
+        logger.critical("Exiting")
         sys.exit(1)